@@ -0,0 +1,46 @@
+'''Vectorized actor ages for many (birthdate, release date) pairs at once.'''
+import numpy as np
+
+
+def parse_dates(values):
+    '''ISO dates as datetime64[D], NaT where missing or unparseable.
+
+    Partial dates are accepted: YYYY means January 1 and YYYY-MM the first
+    of the month, so an age from a partial date can be a year too high.
+    '''
+    values = [value or 'NaT' for value in values]
+    try:
+        return np.array(values, dtype='datetime64[D]')
+    except ValueError:
+        # one bad value fails the whole array; sort them out one at a time
+        parsed = np.empty(len(values), dtype='datetime64[D]')
+        for idx, value in enumerate(values):
+            try:
+                parsed[idx] = np.datetime64(value, 'D')
+            except ValueError:
+                parsed[idx] = np.datetime64('NaT')
+        return parsed
+
+
+def split_dates(dates):
+    '''Year, month and day arrays of a datetime64[D] array.'''
+    years = dates.astype('datetime64[Y]')
+    months = dates.astype('datetime64[M]')
+    return (years.astype(np.int64) + 1970,
+            (months - years).astype(np.int64) + 1,
+            (dates - months).astype(np.int64) + 1)
+
+
+def compute_ages(birthdates, release_dates):
+    '''Whole years between each birthdate and release date, None where either is unusable.'''
+    births = parse_dates(birthdates)
+    releases = parse_dates(release_dates)
+    birth_year, birth_month, birth_day = split_dates(births)
+    release_year, release_month, release_day = split_dates(releases)
+
+    # one less if the birthday had not come round yet that year
+    before_birthday = (release_month < birth_month) | \
+        ((release_month == birth_month) & (release_day < birth_day))
+    ages = release_year - birth_year - before_birthday
+    valid = ~(np.isnat(births) | np.isnat(releases))
+    return [int(age) if ok else None for age, ok in zip(ages.tolist(), valid.tolist())]
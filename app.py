@@ -1,9 +1,31 @@
+import gc
+import logging
 import os
-import random
-from flask import Flask, render_template, request
+import hashlib
+import math
+import re
+import time
+
+IMPORT_START = time.perf_counter()
+
+from flask import Flask, abort, g, jsonify, render_template, request, send_from_directory, url_for
 from flask_graphql import GraphQLView
+from werkzeug.middleware.proxy_fix import ProxyFix
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import configure_mappers
+from migrations import apply_migrations, schema_is_current
 from models import db
-from schema import schema
+from data_version import DataVersionWatcher
+from image_index import ImageIndex
+from media import media_path
+from query_cost import CostBudgets, CostLimitingBackend
+from metrics import (Metrics, ResolverTimingMiddleware, TimedBackend, cache_collector,
+                     instrument_app, instrument_engine)
+from result_cache import ResultCache, ResultCachingBackend, default_backend
+from role_index import RoleIndex
+from snapshot import SnapshotWatcher, make_read_only, sqlite_file
+from schema import (LIST_SIZE_CAPS, RANDOM_ROLE_QUERY, document_backend, persisted_queries,
+                    schema)
 
 # Initialize Flask app
 app = Flask(__name__,
@@ -17,58 +39,162 @@ app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv(
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False  # Suppress SQL logs
 
+API_BATCH_SIZE = 20  # matches per /api/age response by default
+API_MAX_BATCH_SIZE = 100  # largest batch a client may ask for
+API_CACHE_SECONDS = 24 * 60 * 60  # data only changes when the pipeline runs
+API_FORMAT_VERSION = 2  # bump whenever the /api/age response shape changes
+
+TMDB_IMAGE_URL = 'https://image.tmdb.org/t/p/w185'  # used for images not mirrored locally
+MEDIA_CACHE_SECONDS = 365 * 24 * 60 * 60  # mirrored files are named by content, never change
+MEDIA_FILE_NAME = re.compile(r'^[0-9a-f]{64}\.\w+$')
+
+GRAPHIQL = os.getenv('GRAPHIQL', '0') == '1'  # in-browser query editor at /graphql
+PROXY_COUNT = int(os.getenv('PROXY_COUNT', '0'))  # trusted proxies setting X-Forwarded-For
+
+# see the real client address behind a load balancer, for per-client budgets
+if PROXY_COUNT:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_COUNT)
+
 # Initialize the database with the app
 db.init_app(app)
 
 with app.app_context():
-    # Ensure tables are created before the first request
-    db.create_all()
+    # Ensure tables are created and migrated before the first request,
+    # skipping the DDL when a previous start already did it
+    raw_conn = db.engine.raw_connection()
+    try:
+        if not schema_is_current(raw_conn):
+            db.create_all()
+            apply_migrations(raw_conn)
+    finally:
+        raw_conn.close()
+
+
+# Per-worker request, resolver, SQL and cache metrics, served at /metrics
+metrics = Metrics()
+instrument_app(app, metrics)
+with app.app_context():
+    instrument_engine(db.engine, metrics)
+
+# Data version stamped by the pipeline; caches below are keyed to it
+data_version = DataVersionWatcher()
+
+# Serve SQLite read-only and reopen when the pipeline swaps in a new snapshot
+snapshot_watcher = None
+db_file = sqlite_file(app.config['SQLALCHEMY_DATABASE_URI'])
+if db_file:
+    with app.app_context():
+        make_read_only(db.engine)
+        snapshot_watcher = SnapshotWatcher(
+            db_file, db.engine, on_swap=data_version.expire)
+
+
+@app.before_request
+def follow_snapshot():
+    if snapshot_watcher:
+        snapshot_watcher.check()
+
+# Reuse /graphql results until the pipeline refreshes the data
+result_cache = ResultCache(default_backend())
+caching_backend = ResultCachingBackend(
+    document_backend, result_cache, lambda: data_version.current(db.session))
+
+# Cost and depth limits, and per-client cost budgets, checked before execution
+cost_budgets = CostBudgets()
+graphql_backend = TimedBackend(CostLimitingBackend(
+    caching_backend, cost_budgets, lambda: request.remote_addr,
+    size_caps=LIST_SIZE_CAPS), metrics)
+
+
+class SessionGraphQLView(GraphQLView):
+    '''GraphQL view that passes the database session to resolvers.'''
+
+    def get_context(self):
+        return {'session': db.session, 'request': request}
+
+    def parse_body(self):
+        # swap a persisted query hash for its query text
+        data = super().parse_body()
+        if isinstance(data, list):
+            return data
+        return persisted_queries.resolve(data, request.args)
+
+    def dispatch_request(self):
+        response = super().dispatch_request()
+        # a client over its cost budget gets told when to come back
+        retry_after = g.pop('graphql_retry_after', None)
+        if retry_after:
+            response.status_code = 429
+            response.headers['Retry-After'] = str(math.ceil(retry_after))
+        return response
+
 
 # Add GraphQL endpoint
 app.add_url_rule(
     '/graphql',
-    view_func=GraphQLView.as_view(
+    view_func=SessionGraphQLView.as_view(
         'graphql',
         schema=schema,
-        graphiql=True  # Enable GraphiQL interface
+        backend=graphql_backend,
+        middleware=[ResolverTimingMiddleware(metrics)],
+        graphiql=GRAPHIQL
     )
 )
 
+# Per-worker count of matches for each age, and map of mirrored images
+role_index = RoleIndex(data_version)
+image_index = ImageIndex(data_version)
+metrics.collect(cache_collector({'graphql_documents': document_backend,
+                                 'graphql_results': result_cache,
+                                 'role_index': role_index,
+                                 'image_index': image_index}))
+
+
+@app.template_global()
+def image_url(path):
+    '''URL of the locally mirrored copy of a TMDB image path, else of TMDB's.'''
+    file_name = image_index.file_name(path)
+    if file_name:
+        return url_for('media', file_name=file_name)
+    return f'{TMDB_IMAGE_URL}{path}'
+
+
+@app.route('/media/<file_name>')
+def media(file_name):
+    '''Serve a mirrored image; its name is its hash, so it can be cached forever.'''
+    if not MEDIA_FILE_NAME.match(file_name):
+        abort(404)
+    response = send_from_directory(os.path.dirname(media_path(file_name)), file_name,
+                                   max_age=MEDIA_CACHE_SECONDS)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    '''Expose this worker's metrics for Prometheus to scrape.
+
+    Only this worker's: with several gunicorn workers a scrape lands on one of
+    them at random, so run one worker or read the numbers as a sample.
+    '''
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
 
 @app.route('/', methods=['GET', 'POST'])
 def index():
     if request.method == 'POST':
         age = int(request.form['age'])
-        # Use GraphQL query to fetch data
-        query = f'''
-        {{
-            roles(actorAge: {age}) {{
-                actor {{
-                    actorName
-                    imagePath
-                }}
-                movie {{
-                    movieTitle
-                    posterPath
-                }}
-            }}
-        }}
-        '''
-        result = None
-        with app.app_context():
-            result = schema.execute(query, context_value={
-                                    'session': db.session})
-        # Debug result
-        # print('GraphQL Query Results: ', result)
-
-        if result.errors:
-            return render_template('index.html', message="An error occurred. :(" + str(result.errors), result=None)
-
-        data = result.data.get('roles') if result.data else None
-
-        if data and len(data) > 0:
-            # Randomly select a role from the list of results
-            node = random.choice(data)
+        try:
+            # rebuilds only on first use or after a data refresh
+            role_index.refresh(db.session)
+            image_index.refresh(db.session)
+            # Randomly select a match for this age with one primary-key read
+            node = role_index.pick(db.session, age)
+        except SQLAlchemyError as e:
+            return render_template('index.html', message="An error occurred. :(" + str(e), result=None)
+
+        if node:
             message = f"You're about as old as...<br>\
             {node['actor']['actorName']} in <i>{node['movie']['movieTitle']}</i>."
             return render_template('index.html', message=message, result=node, age=age)
@@ -80,5 +206,92 @@ def index():
     return render_template('index.html', message='', result=None, age=None)
 
 
+@app.route('/api/age/<int:age>')
+def api_age(age):
+    '''Return a pre-shuffled batch of matches for an age as cacheable JSON.'''
+    size = max(1, min(request.args.get('count', API_BATCH_SIZE, type=int),
+                      API_MAX_BATCH_SIZE))
+    page = max(0, request.args.get('page', 0, type=int))
+    try:
+        role_index.refresh(db.session)
+        image_index.refresh(db.session)
+    except SQLAlchemyError:
+        return jsonify(error='database unavailable'), 503
+
+    # the batch is fixed for a data version and response format, so the ETag
+    # can be computed up front
+    tag = f'{API_FORMAT_VERSION}:{role_index.version}:{age}:{size}:{page}'
+    etag = hashlib.sha256(tag.encode('utf-8')).hexdigest()[:32]
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        try:
+            matches = role_index.batch(db.session, age, size, page)
+        except SQLAlchemyError:
+            return jsonify(error='database unavailable'), 503
+        # image URLs point at the local mirror where there is one
+        matches = [[actor_name, image_url(image_path), movie_title, image_url(poster_path)]
+                   for actor_name, image_path, movie_title, poster_path in matches]
+        response = jsonify(age=age, page=page,
+                           fields=['actorName', 'imageUrl',
+                                   'movieTitle', 'posterUrl'],
+                           matches=matches)
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = API_CACHE_SECONDS
+    return response
+
+
+# requests replayed by warmup(), covering the routes, templates and hot queries
+WARMUP_AGE = 30
+WARMUP_REQUESTS = [
+    ('GET', '/', {}),
+    ('POST', '/', {'data': {'age': str(WARMUP_AGE)}}),
+    ('GET', f'/api/age/{WARMUP_AGE}', {}),
+    ('POST', '/graphql', {'json': {'query': RANDOM_ROLE_QUERY,
+                                   'variables': {'age': WARMUP_AGE}}}),
+]
+
+
+def warmup():
+    '''Pay first-request costs once, so forked workers share them copy-on-write.
+
+    Run in the gunicorn master before workers fork (see gunicorn.conf.py).
+    Returns the seconds taken.
+    '''
+    start = time.perf_counter()
+    configure_mappers()
+    app.jinja_env.get_template('index.html')
+    # fills the role index, compiled SQL and template caches along the way
+    client = app.test_client()
+    for method, path, kwargs in WARMUP_REQUESTS:
+        response = client.open(path, method=method, **kwargs)
+        if response.status_code >= 400:
+            logging.warning("Warmup %s %s returned %d", method, path, response.status_code)
+    # warmup traffic is not real traffic
+    metrics.reset()
+    # no pooled connections may be shared with forked workers
+    with app.app_context():
+        db.engine.dispose()
+    result_cache.backend.close()
+    # keep the warmed objects out of collections, so their pages stay shared
+    gc.freeze()
+    seconds = time.perf_counter() - start
+    logging.info("Warmed up in %.0fms", seconds * 1000)
+    return seconds
+
+
+def after_fork():
+    '''Reset per-process state in a freshly forked worker.'''
+    with app.app_context():
+        # drop any connections inherited from the master without closing them under it
+        db.engine.dispose(close=False)
+    result_cache.backend.after_fork()
+
+
+IMPORT_SECONDS = time.perf_counter() - IMPORT_START
+logging.info("Imported app in %.0fms", IMPORT_SECONDS * 1000)
+
+
 if __name__ == '__main__':
     app.run()
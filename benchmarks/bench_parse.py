@@ -0,0 +1,63 @@
+'''Benchmark export parsing in fetch_archives.py across worker counts.'''
+import argparse
+import gzip
+import json
+import os
+import tempfile
+
+from common import timed
+from synthetic import write_export
+import fetch_archives  # pylint: disable=wrong-import-order
+
+
+def decode_every_line(filenames):
+    '''Reference: the old approach of json.loads on every line.'''
+    sums = {}
+    for file_name in filenames:
+        with gzip.open(file_name, 'rb') as file:
+            for line in file:
+                record = json.loads(line)
+                if record['popularity'] >= fetch_archives.POPULARITY_CUTOFF:
+                    sums[record['id']] = sums.get(
+                        record['id'], 0.0) + record['popularity']
+    return sums
+
+
+def main():
+    '''Time parsing a synthetic export with 1..N workers and print JSON results.'''
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--people', type=int, default=1_000_000,
+                        help='lines per synthetic export')
+    parser.add_argument('--exports', type=int,
+                        default=fetch_archives.NUMBER_OF_EXPORTS)
+    parser.add_argument('--max-workers', type=int,
+                        default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filenames = []
+        for idx in range(args.exports):
+            path = os.path.join(tmp_dir, f'person_ids_{idx}.json.gz')
+            write_export(path, args.people, seed=idx)
+            filenames.append(path)
+
+        results = []
+        seconds, expected = timed(decode_every_line, filenames)
+        results.append({'mode': 'decode_every_line', 'workers': 1,
+                        'seconds': round(seconds, 3)})
+
+        workers = 1
+        while workers <= args.max_workers:
+            seconds, sums = timed(fetch_archives.sum_popularity, filenames, workers)
+            assert sums.keys() == expected.keys()
+            results.append({'mode': 'sum_popularity', 'workers': workers,
+                            'seconds': round(seconds, 3),
+                            'speedup': round(results[0]['seconds'] / seconds, 2)})
+            workers *= 2
+
+    print(json.dumps({'people_per_export': args.people, 'exports': args.exports,
+                      'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+'''Benchmark each pipeline stage against the local stub TMDB server.
+
+    python benchmarks/bench_pipeline.py --actors 1000 --people 1000000 --repeat 3
+'''
+import argparse
+import contextlib
+import logging
+import os
+import tempfile
+
+from common import report, summarize, timed
+from stub_tmdb import base_url, image_base_url, serve
+from synthetic import write_export
+
+
+class Stages:
+    '''Collect timings per stage across repeats.'''
+
+    def __init__(self):
+        self.samples = {}
+
+    def run(self, name, fn, *args):
+        seconds, result = timed(fn, *args)
+        self.samples.setdefault(name, []).append(seconds)
+        return result
+
+    def summary(self):
+        return {name: summarize(samples) for name, samples in self.samples.items()}
+
+
+def bench_archives(fetch_archives, http_cache, stages, run_dir, workers):
+    '''One pass of fetch_archives.py: names, downloads, parsing and selection.'''
+    filenames = stages.run('archives.generate_export_filenames',
+                           fetch_archives.generate_export_filenames)
+    cache = http_cache.HTTPCache(root=os.path.join(run_dir, 'http_cache'))
+    paths = stages.run('archives.download', fetch_archives.download_file_with_progress,
+                       filenames, cache)
+    sums = stages.run('archives.sum_popularity', fetch_archives.sum_popularity,
+                      paths, workers)
+    stages.run('archives.select_popular_actors', fetch_archives.select_popular_actors,
+               sums, os.path.join(run_dir, 'popular_actors.txt'))
+
+
+def bench_actors(fetch_actor_data, tmdb_client, http_cache, stages, run_dir, actor_ids,
+                 server, requests_per_second):
+    '''One refresh of fetch_actor_data.py into a new database, then a replay from cache.'''
+    # pylint: disable=import-outside-toplevel
+    from mirror_images import ImageMirror, mirror_images
+    mirror = ImageMirror(image_base_url(server), root=os.path.join(run_dir, 'media'))
+    cache = http_cache.HTTPCache(root=os.path.join(run_dir, 'http_cache'))
+    fetch_actor_data.tmdb = tmdb_client.TMDBClient(
+        None, base_url(server), requests_per_second, fetch_actor_data.MAX_WORKERS,
+        cache=cache)
+
+    for label in ('actors', 'actors_cached'):
+        fetch_actor_data.DB_PATH = os.path.join(run_dir, f'{label}.db')
+        fetch_actor_data.open_snapshot()
+        fetch_actor_data.create_tables()
+        stages.run(f'{label}.process_actors', fetch_actor_data.process_actors, actor_ids)
+        stages.run(f'{label}.build_age_matches', fetch_actor_data.build_age_matches)
+        stages.run(f'{label}.mirror_images', mirror_images, fetch_actor_data.conn, mirror)
+        fetch_actor_data.bump_data_version()
+        stages.run(f'{label}.validate_snapshot', fetch_actor_data.validate_snapshot)
+        stages.run(f'{label}.publish_snapshot', fetch_actor_data.publish_snapshot)
+
+
+def main():
+    '''Time each fetch_archives.py and fetch_actor_data.py stage and print percentiles as JSON.'''
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--actors', type=int, default=500,
+                        help='actors fetched by process_actors')
+    parser.add_argument('--people', type=int, default=200_000,
+                        help='lines per synthetic export')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='processes used to parse exports')
+    parser.add_argument('--requests-per-second', type=float, default=1000,
+                        help='client rate limit; the real API allows about 50')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds the stub adds to every response')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of stub person requests answered with 429')
+    parser.add_argument('--truncate-rate', type=float, default=0.0,
+                        help='fraction of stub export responses cut off halfway, '
+                             'so downloads resume with Range requests')
+    parser.add_argument('--output', help='append results to this JSON lines file')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir, \
+            open(os.devnull, 'w', encoding='utf-8') as devnull:
+        # the pipeline modules read these at import time and write relative to the cwd
+        os.environ['HTTP_CACHE_DIR'] = os.path.join(tmp_dir, 'http_cache')
+        os.chdir(tmp_dir)
+        # pylint: disable=import-outside-toplevel
+        import fetch_actor_data
+        import fetch_archives
+        import http_cache
+        import tmdb_client
+        logging.getLogger().setLevel(logging.WARNING)
+
+        exports_dir = os.path.join(tmp_dir, 'exports')
+        os.makedirs(exports_dir)
+        server = serve(exports_dir=exports_dir, latency=args.latency,
+                       error_rate=args.error_rate, truncate_rate=args.truncate_rate)
+        fetch_archives.DAILY_EXPORT_URL = \
+            f'http://127.0.0.1:{server.server_address[1]}/p/exports/'
+        with contextlib.redirect_stdout(devnull):
+            filenames = fetch_archives.generate_export_filenames()
+        for seed, url in enumerate(filenames):
+            write_export(os.path.join(exports_dir, url.rsplit('/', 1)[1]), args.people, seed)
+
+        stages = Stages()
+        actor_ids = list(range(1, args.actors + 1))
+        for idx in range(args.repeat):
+            run_dir = os.path.join(tmp_dir, f'run{idx}')
+            os.makedirs(run_dir)
+            with contextlib.redirect_stdout(devnull):
+                bench_archives(fetch_archives, http_cache, stages, run_dir, args.workers)
+                bench_actors(fetch_actor_data, tmdb_client, http_cache, stages, run_dir,
+                             actor_ids, server, args.requests_per_second)
+
+        results = stages.summary()
+        for label in ('actors', 'actors_cached'):
+            median = results[f'{label}.process_actors']['p50_ms'] / 1000
+            results[f'{label}.process_actors']['actors_per_second'] = \
+                round(args.actors / median, 1)
+        results['stub_requests'] = server.requests
+        server.shutdown()
+
+    report('pipeline', {'actors': args.actors, 'people_per_export': args.people,
+                        'exports': len(filenames), 'repeat': args.repeat,
+                        'workers': args.workers, 'latency': args.latency,
+                        'error_rate': args.error_rate,
+                        'truncate_rate': args.truncate_rate},
+           results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+'''Benchmark the web app's hot paths against a synthetic database.
+
+    python benchmarks/bench_web.py --roles 1000000 --requests 2000 --threads 4
+'''
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+
+from common import report, summarize, timed
+from synthetic import write_database
+
+NESTED_ROLES_QUERY = '''
+query NestedRoles($age: Int!) {
+  roles(actorAge: $age, limit: 50) {
+    actorAge
+    actor { actorName imagePath }
+    movie { movieTitle posterPath }
+  }
+}
+'''
+NESTED_CONNECTION_QUERY = '''
+{
+  allActors(first: 20) {
+    edges { node { actorName roles(first: 10) {
+      edges { node { actorAge movie { movieTitle } } }
+    } } }
+  }
+}
+'''
+
+
+def workloads(app_module):
+    '''Named request functions, each taking a test client and a random age.'''
+    from schema import RANDOM_ROLE_QUERY  # pylint: disable=import-outside-toplevel
+    clear_results = app_module.result_cache.backend.clear
+
+    def graphql(client, query, variables=None):
+        response = client.post('/graphql', json={'query': query, 'variables': variables})
+        assert 'errors' not in response.get_json(), response.get_json()
+        return response
+
+    def uncached(fn):
+        def run(client, age):
+            clear_results()
+            return fn(client, age)
+        return run
+
+    def nested_roles(client, age):
+        return graphql(client, NESTED_ROLES_QUERY, {'age': age})
+
+    def nested_connection(client, _age):
+        return graphql(client, NESTED_CONNECTION_QUERY)
+
+    return {
+        'index': lambda client, age: client.post('/', data={'age': str(age)}),
+        'api_age': lambda client, age: client.get(f'/api/age/{age}'),
+        'graphql_random_role': lambda client, age: graphql(
+            client, RANDOM_ROLE_QUERY, {'age': age}),
+        'graphql_nested_roles': uncached(nested_roles),
+        'graphql_nested_roles_cached': nested_roles,
+        'graphql_nested_connection': uncached(nested_connection),
+    }
+
+
+def run_workload(app, fn, requests, threads, seed):
+    '''Issue requests across threads; return per-request latencies and wall time.'''
+    latencies = []
+    lock = threading.Lock()
+    per_thread = max(requests // threads, 1)
+
+    def worker(idx):
+        rng = random.Random(seed + idx)
+        client = app.test_client()
+        samples = []
+        for _ in range(per_thread):
+            seconds, response = timed(fn, client, rng.randint(18, 80))
+            assert response.status_code == 200, response.status_code
+            samples.append(seconds)
+        with lock:
+            latencies.extend(samples)
+
+    start = time.perf_counter()
+    pool = [threading.Thread(target=worker, args=(idx,)) for idx in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    return latencies, time.perf_counter() - start
+
+
+def main():
+    '''Time index(), /api/age and /graphql requests and print latency percentiles as JSON.'''
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--roles', type=int, default=100_000,
+                        help='size of the synthetic database')
+    parser.add_argument('--db', help='reuse an existing database instead of generating one')
+    parser.add_argument('--requests', type=int, default=500,
+                        help='requests per workload')
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--only', nargs='*', help='workloads to run')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='append results to this JSON lines file')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = args.db
+        setup_seconds = 0.0
+        if not db_path:
+            db_path = os.path.join(tmp_dir, 'bench.db')
+            setup_seconds, _ = timed(write_database, db_path, args.roles, args.seed)
+
+        # the app reads its configuration at import time
+        os.environ['DATABASE_URL'] = f'sqlite:///{os.path.abspath(db_path)}'
+        os.environ.pop('RESULT_CACHE_PATH', None)
+        # every request comes from one client; measure latency, not the budget
+        os.environ.setdefault('CLIENT_COST_PER_MINUTE', str(10 ** 12))
+        import app as app_module  # pylint: disable=import-outside-toplevel
+
+        results = {}
+        for name, fn in workloads(app_module).items():
+            if args.only and name not in args.only:
+                continue
+            # one untimed pass so caches and the connection pool are warm
+            run_workload(app_module.app, fn, min(args.requests, 20), 1, args.seed)
+            latencies, wall = run_workload(app_module.app, fn, args.requests,
+                                           args.threads, args.seed)
+            results[name] = summarize(latencies)
+            results[name]['throughput_rps'] = round(len(latencies) / wall, 1)
+
+    report('web', {'roles': args.roles if not args.db else None, 'db': args.db,
+                   'requests': args.requests, 'threads': args.threads,
+                   'setup_seconds': round(setup_seconds, 3)},
+           results, args.output)
+
+
+if __name__ == '__main__':
+    main()
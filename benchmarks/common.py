@@ -0,0 +1,48 @@
+'''Timing and reporting helpers shared by the benchmarks.'''
+import json
+import math
+import os
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_DIR not in sys.path:
+    sys.path.insert(0, REPO_DIR)
+
+PERCENTILES = (50, 90, 95, 99)
+
+
+def timed(fn, *args, **kwargs):
+    '''Return (seconds, result) for one call.'''
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def percentile(ordered, pct):
+    '''Nearest-rank percentile of an already sorted list.'''
+    rank = max(math.ceil(pct / 100 * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+def summarize(samples):
+    '''Percentiles of a list of durations in seconds, reported in milliseconds.'''
+    if not samples:
+        return {'count': 0}
+    ordered = sorted(samples)
+    summary = {'count': len(ordered),
+               'mean_ms': round(sum(ordered) / len(ordered) * 1000, 3)}
+    for pct in PERCENTILES:
+        summary[f'p{pct}_ms'] = round(percentile(ordered, pct) * 1000, 3)
+    summary['max_ms'] = round(ordered[-1] * 1000, 3)
+    return summary
+
+
+def report(name, params, results, output=None):
+    '''Print one benchmark run as JSON, and append it to output as a JSON line.'''
+    record = {'benchmark': name, 'params': params,
+              'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': results}
+    print(json.dumps(record, indent=2))
+    if output:
+        with open(output, 'a', encoding='utf-8') as file:
+            file.write(json.dumps(record) + '\n')
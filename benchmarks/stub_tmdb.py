@@ -0,0 +1,150 @@
+'''Local stand-in for the TMDB API and export file server.
+
+    python benchmarks/stub_tmdb.py --port 8765 --exports /tmp/exports
+
+Then point the pipeline at it with TMDB_BASE_URL=http://127.0.0.1:8765/3,
+and mirror_images.py with IMAGE_BASE_URL=http://127.0.0.1:8765/t/p/w342.
+'''
+import argparse
+import json
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import common  # noqa: F401 pylint: disable=unused-import
+from synthetic import image_bytes, person_payload
+
+PERSON_PATH = re.compile(r'^/3/person/(\d+)(/movie_credits)?(?:\?|$)')
+EXPORT_PATH = re.compile(r'^/p/exports/([\w.-]+\.json\.gz)$')
+RANGE_HEADER = re.compile(r'^bytes=(\d+)-(\d*)$')
+IMAGE_PATH = re.compile(r'^/t/p/\w+/([\w-]+)\.\w+$')
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    '''Serve deterministic person responses, images and export files.
+
+    Export files honour single Range requests, and a share of them can be cut
+    off partway to exercise the downloader's resume path.
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def send_body(self, status, body, content_type='application/json', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_export(self, path, truncate):
+        with open(path, 'rb') as file:
+            body = file.read()
+        size = len(body)
+        match = RANGE_HEADER.match(self.headers.get('Range', ''))
+        if match is None:
+            status, start, end, headers = 200, 0, size, {}
+        else:
+            start = int(match.group(1))
+            end = min(int(match.group(2)) + 1, size) if match.group(2) else size
+            if start >= size or start >= end:
+                self.send_body(416, b'', headers={'Content-Range': f'bytes */{size}'})
+                return
+            status = 206
+            headers = {'Content-Range': f'bytes {start}-{end - 1}/{size}'}
+
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/gzip')
+        self.send_header('Content-Length', str(end - start))
+        self.end_headers()
+        if truncate and end - start > 1:
+            # promise the whole range, send half, hang up
+            self.wfile.write(body[start:start + (end - start) // 2])
+            self.close_connection = True
+        else:
+            self.wfile.write(body[start:end])
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        with server.lock:
+            server.requests += 1
+            throttled = server.rng.random() < server.error_rate
+            truncated = server.rng.random() < server.truncate_rate
+
+        person = PERSON_PATH.match(self.path)
+        export = EXPORT_PATH.match(self.path)
+        image = IMAGE_PATH.match(self.path)
+        if person and throttled:
+            self.send_body(429, b'{}', headers={'Retry-After': '0'})
+        elif person:
+            payload = person_payload(int(person.group(1)))
+            if person.group(2):
+                payload = payload['movie_credits']
+            self.send_body(200, json.dumps(payload).encode('utf-8'))
+        elif image:
+            self.send_body(200, image_bytes(image.group(1)), 'image/png')
+        elif export and server.exports_dir and \
+                os.path.exists(os.path.join(server.exports_dir, export.group(1))):
+            self.send_export(os.path.join(server.exports_dir, export.group(1)), truncated)
+        else:
+            self.send_body(404, b'{"status_message": "not found"}')
+
+
+def serve(port=0, exports_dir=None, latency=0.0, error_rate=0.0, seed=0, truncate_rate=0.0):
+    '''Start the stub on a background thread; port 0 picks a free one.'''
+    server = ThreadingHTTPServer(('127.0.0.1', port), StubHandler)
+    server.daemon_threads = True
+    server.exports_dir = exports_dir
+    server.latency = latency
+    server.error_rate = error_rate
+    server.truncate_rate = truncate_rate
+    server.rng = random.Random(seed)
+    server.lock = threading.Lock()
+    server.requests = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def base_url(server):
+    '''The TMDB_BASE_URL for a running stub.'''
+    return f'http://127.0.0.1:{server.server_address[1]}/3'
+
+
+def image_base_url(server):
+    '''The IMAGE_BASE_URL for a running stub.'''
+    return f'http://127.0.0.1:{server.server_address[1]}/t/p/w342'
+
+
+def main():
+    '''Run the stub TMDB server until interrupted.'''
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--exports', help='directory of person_ids_*.json.gz files')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every response')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of person requests answered with 429')
+    parser.add_argument('--truncate-rate', type=float, default=0.0,
+                        help='fraction of export responses cut off halfway')
+    args = parser.parse_args()
+    server = serve(args.port, args.exports, args.latency, args.error_rate,
+                   truncate_rate=args.truncate_rate)
+    print(f'Serving TMDB stub at {base_url(server)}')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+'''Deterministic synthetic data: MoviePeers databases and TMDB-shaped exports and responses.
+
+    python benchmarks/synthetic.py database --roles 1000000 /tmp/bench.db
+    python benchmarks/synthetic.py export --people 1000000 /tmp/person_ids.json.gz
+'''
+import argparse
+import gzip
+import json
+import os
+import random
+import sqlite3
+import struct
+import time
+import zlib
+from datetime import date, timedelta
+
+import common  # noqa: F401 pylint: disable=unused-import
+from sqlalchemy import create_engine  # pylint: disable=wrong-import-order
+from migrations import BUILD_WEIGHTED_AGE_MATCHES, apply_migrations
+from models import db
+from weighted_sampling import build_alias_tables
+
+ROLES_PER_ACTOR = 20  # roughly what a popular actor's credits yield
+ROLES_PER_MOVIE = 4  # cast members of a movie that are in the database
+INSERT_BATCH_SIZE = 50_000
+
+FIRST_BIRTHDAY = date(1920, 1, 1)
+LAST_BIRTHDAY = date(2005, 12, 31)
+LAST_RELEASE = date(2025, 12, 31)
+
+IMAGE_WIDTH = 342  # synthetic images are wider than the thumbnails made from them
+IMAGE_HEIGHT = 513
+
+
+def random_date(rng, start, end):
+    '''A uniformly random ISO date between start and end.'''
+    return (start + timedelta(days=rng.randrange((end - start).days + 1))).isoformat()
+
+
+def person_payload(person_id, credits=ROLES_PER_ACTOR, movies=None):
+    '''A /person/<id>?append_to_response=movie_credits response, the same for every call.'''
+    rng = random.Random(person_id)
+    movies = movies or max(credits * 50, 1000)
+    birthday = date.fromisoformat(random_date(rng, FIRST_BIRTHDAY, LAST_BIRTHDAY))
+    cast = []
+    for movie_id in rng.sample(range(1, movies + 1), credits):
+        movie_rng = random.Random(-movie_id)
+        cast.append({'id': movie_id, 'title': f'Movie {movie_id}',
+                     'release_date': random_date(movie_rng, birthday, LAST_RELEASE),
+                     'poster_path': f'/poster{movie_id}.jpg',
+                     'popularity': round(movie_rng.paretovariate(1.5), 3)})
+    return {'id': person_id, 'name': f'Actor {person_id}',
+            'birthday': birthday.isoformat(),
+            'profile_path': f'/profile{person_id}.jpg',
+            'popularity': round(rng.paretovariate(1.5), 3),
+            'movie_credits': {'cast': cast, 'crew': []}}
+
+
+def png_chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + \
+        struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+
+def image_bytes(name):
+    '''A PNG of one colour picked by name, for the stub image server.'''
+    rng = random.Random(name)
+    pixel = bytes(rng.randrange(256) for _ in range(3))
+    rows = (b'\x00' + pixel * IMAGE_WIDTH) * IMAGE_HEIGHT  # filter byte per row
+    header = struct.pack('>IIBBBBB', IMAGE_WIDTH, IMAGE_HEIGHT, 8, 2, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + png_chunk(b'IHDR', header) + \
+        png_chunk(b'IDAT', zlib.compress(rows)) + png_chunk(b'IEND', b'')
+
+
+def write_export(path, people, seed=0):
+    '''Write a TMDB-shaped person export where roughly 0.5% clear the popularity cutoff.'''
+    rng = random.Random(seed)
+    with gzip.open(path, 'wt', encoding='utf-8') as file:
+        for person_id in range(people):
+            record = {'adult': False, 'id': person_id, 'name': f'Person {person_id}',
+                      'popularity': round(rng.paretovariate(1.5) * 0.6, 3)}
+            file.write(json.dumps(record) + '\n')
+
+
+def generate_rows(roles, seed):
+    '''Yield (table, row) pairs for a database with about the given number of roles.'''
+    rng = random.Random(seed)
+    actors = max(roles // ROLES_PER_ACTOR, 1)
+    movies = max(roles // ROLES_PER_MOVIE, ROLES_PER_ACTOR)
+
+    release_dates = {}
+    for movie_id in range(1, movies + 1):
+        release = random_date(rng, FIRST_BIRTHDAY, LAST_RELEASE)
+        release_dates[movie_id] = date.fromisoformat(release)
+        yield 'movies', (movie_id, f'Movie {movie_id}', release, f'/poster{movie_id}.jpg',
+                         round(rng.paretovariate(1.5), 3))
+
+    role_id = 0
+    for actor_id in range(1, actors + 1):
+        birthday = date.fromisoformat(random_date(rng, FIRST_BIRTHDAY, LAST_BIRTHDAY))
+        yield 'actors', (actor_id, f'Actor {actor_id}', birthday.isoformat(),
+                         f'/profile{actor_id}.jpg', round(rng.paretovariate(1.5), 3))
+        for movie_id in rng.sample(range(1, movies + 1), min(ROLES_PER_ACTOR, movies)):
+            release = release_dates[movie_id]
+            age = release.year - birthday.year - \
+                ((release.month, release.day) < (birthday.month, birthday.day))
+            role_id += 1
+            yield 'roles', (role_id, actor_id, movie_id, age if age >= 0 else None)
+
+
+def write_database(path, roles, seed=0):
+    '''Write a migrated, fully built MoviePeers database with about `roles` roles.'''
+    if os.path.exists(path):
+        os.remove(path)
+    # same schema the web app creates, then the pipeline's migrations
+    engine = create_engine(f'sqlite:///{path}')
+    db.metadata.create_all(engine)
+    engine.dispose()
+
+    conn = sqlite3.connect(path)
+    apply_migrations(conn)
+    conn.execute('PRAGMA journal_mode=OFF')
+    conn.execute('PRAGMA synchronous=OFF')
+    statements = {
+        'actors': 'INSERT INTO actors (id, actor_name, birthdate, image_path, popularity) '
+                  'VALUES (?, ?, ?, ?, ?)',
+        'movies': 'INSERT INTO movies (id, movie_title, release_date, poster_path, popularity) '
+                  'VALUES (?, ?, ?, ?, ?)',
+        'roles': 'INSERT INTO roles (id, actor_id, movie_id, actor_age) VALUES (?, ?, ?, ?)',
+    }
+    pending = {table: [] for table in statements}
+    with conn:
+        for table, row in generate_rows(roles, seed):
+            pending[table].append(row)
+            if len(pending[table]) >= INSERT_BATCH_SIZE:
+                conn.executemany(statements[table], pending[table])
+                pending[table].clear()
+        for table, rows in pending.items():
+            conn.executemany(statements[table], rows)
+        conn.execute('DELETE FROM age_matches')
+        conn.execute(BUILD_WEIGHTED_AGE_MATCHES)
+        conn.execute("INSERT OR REPLACE INTO app_meta (key, value) VALUES ('data_version', '1')")
+    build_alias_tables(conn)
+    conn.execute('ANALYZE')
+    conn.close()
+
+
+def main():
+    '''Write a synthetic database or person export.'''
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    subparsers = parser.add_subparsers(dest='kind', required=True)
+    database = subparsers.add_parser('database', help='actors/movies/roles database')
+    database.add_argument('--roles', type=int, default=100_000)
+    database.add_argument('path')
+    export = subparsers.add_parser('export', help='gzipped person_ids export')
+    export.add_argument('--people', type=int, default=1_000_000)
+    export.add_argument('path')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.kind == 'database':
+        write_database(args.path, args.roles, args.seed)
+    else:
+        write_export(args.path, args.people, args.seed)
+    print(json.dumps({'kind': args.kind, 'path': args.path,
+                      'seconds': round(time.perf_counter() - start, 3)}))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+'''Stage fetched rows in unindexed tables, then merge them into the real tables at once.'''
+import logging
+import time
+
+STAGING_TABLES = {
+    'staging_actors': '(id INTEGER, actor_name TEXT, birthdate TEXT, image_path TEXT, '
+                      'popularity REAL)',
+    'staging_movies': '(id INTEGER, movie_title TEXT, release_date TEXT, poster_path TEXT, '
+                      'popularity REAL)',
+    'staging_roles': '(actor_id INTEGER, movie_id INTEGER, actor_age INTEGER)',
+    'staging_replaced': '(actor_id INTEGER)',
+}
+
+# the unique index stays, the upsert into roles is keyed on it
+KEEP_ROLE_INDEXES = ('uq_roles_actor_movie',)
+# rebuild the other role indexes when staging at least this share of roles
+REBUILD_INDEXES_FRACTION = 0.25
+
+# latest staged row wins when an id was staged more than once
+MERGE_STATEMENTS = [
+    '''DELETE FROM roles
+       WHERE actor_id IN (SELECT actor_id FROM staging_replaced)''',
+    '''INSERT INTO actors (id, actor_name, birthdate, image_path, popularity)
+       SELECT id, actor_name, birthdate, image_path, popularity FROM staging_actors
+       WHERE rowid IN (SELECT MAX(rowid) FROM staging_actors GROUP BY id)
+       ON CONFLICT (id) DO UPDATE SET
+           actor_name = excluded.actor_name,
+           birthdate = excluded.birthdate,
+           image_path = excluded.image_path,
+           popularity = excluded.popularity''',
+    '''INSERT INTO movies (id, movie_title, release_date, poster_path, popularity)
+       SELECT id, movie_title, release_date, poster_path, popularity FROM staging_movies
+       WHERE rowid IN (SELECT MAX(rowid) FROM staging_movies GROUP BY id)
+       ON CONFLICT (id) DO UPDATE SET
+           movie_title = excluded.movie_title,
+           release_date = excluded.release_date,
+           poster_path = excluded.poster_path,
+           popularity = excluded.popularity''',
+    '''INSERT INTO roles (actor_id, movie_id, actor_age)
+       SELECT actor_id, movie_id, actor_age FROM staging_roles
+       WHERE rowid IN (SELECT MAX(rowid) FROM staging_roles
+                       GROUP BY actor_id, movie_id)
+       ORDER BY actor_id, movie_id
+       ON CONFLICT (actor_id, movie_id) DO UPDATE SET
+           actor_age = excluded.actor_age''',
+]
+
+
+def drop_staging(cursor):
+    '''Throw away anything staged by an earlier, unfinished run.'''
+    for table in STAGING_TABLES:
+        cursor.execute(f'DROP TABLE IF EXISTS {table}')
+
+
+class BulkLoader:
+    '''Append batches to staging tables, then merge them into actors, movies and roles.
+
+    Staging tables live in the snapshot file, so a run that dies after staging
+    some batches merges them when it resumes. Durability is relaxed while
+    loading; the snapshot is integrity checked before it is published.
+    '''
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.cursor = conn.cursor()
+        self.staging_seconds = 0.0
+        self.cursor.execute('PRAGMA synchronous=OFF')
+        self.cursor.execute('PRAGMA temp_store=MEMORY')
+        self.cursor.execute('PRAGMA cache_size=-262144')  # 256MB
+        for table, columns in STAGING_TABLES.items():
+            self.cursor.execute(f'CREATE TABLE IF NOT EXISTS {table} {columns}')
+        self.conn.commit()
+
+    def stage(self, actors, movies, roles, states, replaced_actors):
+        '''Append one batch, recording fetch state in the same transaction.'''
+        start = time.perf_counter()
+        with self.conn:
+            self.cursor.executemany(
+                'INSERT INTO staging_actors VALUES (?, ?, ?, ?, ?)', actors)
+            self.cursor.executemany(
+                'INSERT INTO staging_movies VALUES (?, ?, ?, ?, ?)', movies)
+            self.cursor.executemany(
+                'INSERT INTO staging_roles VALUES (?, ?, ?)', roles)
+            self.cursor.executemany(
+                'INSERT INTO staging_replaced VALUES (?)', replaced_actors)
+            # committed together with the staged rows, so a crashed run resumes here
+            self.cursor.executemany('''
+                INSERT INTO fetch_state (actor_id, last_fetched, content_hash)
+                VALUES (?, ?, ?)
+                ON CONFLICT (actor_id) DO UPDATE SET
+                    last_fetched = excluded.last_fetched,
+                    content_hash = excluded.content_hash''', states)
+        self.staging_seconds += time.perf_counter() - start
+
+    def merge(self):
+        '''Merge everything staged in one transaction, building role indexes afterwards.'''
+        start = time.perf_counter()
+        with self.conn:
+            # explicit, so the index drops and rebuilds share the transaction
+            self.cursor.execute('BEGIN')
+            counts = {table: self.cursor.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+                      for table in ('staging_actors', 'staging_movies', 'staging_roles', 'roles')}
+            staged = counts['staging_actors'] + counts['staging_movies'] + counts['staging_roles']
+
+            # for big loads, secondary indexes are cheaper to build once than to maintain per row
+            indexes = []
+            if counts['staging_roles'] >= counts['roles'] * REBUILD_INDEXES_FRACTION:
+                indexes = self.cursor.execute(
+                    "SELECT name, sql FROM sqlite_master WHERE type = 'index' "
+                    "AND tbl_name = 'roles' AND sql IS NOT NULL").fetchall()
+                indexes = [(name, sql) for name, sql in indexes
+                           if name not in KEEP_ROLE_INDEXES]
+            for name, _ in indexes:
+                self.cursor.execute(f'DROP INDEX {name}')
+
+            for statement in MERGE_STATEMENTS:
+                self.cursor.execute(statement)
+            for _, sql in indexes:
+                self.cursor.execute(sql)
+            drop_staging(self.cursor)
+        self.cursor.execute('PRAGMA synchronous=FULL')
+
+        merge_seconds = time.perf_counter() - start
+        total_seconds = self.staging_seconds + merge_seconds
+        logging.info("Loaded %d rows: staged in %.2fs, merged in %.2fs (%.0f rows/s).",
+                     staged, self.staging_seconds, merge_seconds,
+                     staged / total_seconds if total_seconds else 0)
+        return staged
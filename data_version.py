@@ -0,0 +1,73 @@
+'''Track the data version the pipeline stamps after each refresh.'''
+import threading
+import time
+from models import AppMeta
+
+VERSION_CHECK_INTERVAL = 5  # seconds between data version checks
+
+
+def get_data_version(session):
+    '''Read the data version stamped by the pipeline after each refresh.'''
+    return session.query(AppMeta.value).filter(
+        AppMeta.key == 'data_version').scalar()
+
+
+class DataVersionWatcher:
+    '''Remember the data version, re-reading it at most every VERSION_CHECK_INTERVAL.'''
+
+    def __init__(self):
+        self.version = None
+        self.checked_at = None
+        self.lock = threading.Lock()
+
+    def current(self, session):
+        '''Return the data version, checking the database if the last look is stale.'''
+        now = time.monotonic()
+        if self.checked_at is None or now - self.checked_at >= VERSION_CHECK_INTERVAL:
+            with self.lock:
+                self.version = get_data_version(session)
+                self.checked_at = now
+        return self.version
+
+    def expire(self):
+        '''Force the next call to current() to read the database.'''
+        self.checked_at = None
+
+
+class VersionedIndex:
+    '''In-memory index rebuilt from the database whenever the data version moves.
+
+    Subclasses implement load(session) to fill in their contents.
+    '''
+
+    def __init__(self, watcher):
+        self.watcher = watcher
+        self._version = None
+        self._loaded = False
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def version(self):
+        return self._version
+
+    def load(self, session):
+        raise NotImplementedError
+
+    def build(self, session):
+        '''Load the index and remember which data version it reflects.'''
+        version = self.watcher.current(session)
+        self.load(session)
+        self._version = version
+        self._loaded = True
+
+    def refresh(self, session):
+        '''Rebuild the index if it is missing or the data version has moved.'''
+        if self._loaded and self.watcher.current(session) == self._version:
+            self.hits += 1
+            return
+        with self._lock:
+            if not self._loaded or self.watcher.current(session) != self._version:
+                self.misses += 1
+                self.build(session)
@@ -1,30 +1,160 @@
 '''Process actors and update database.'''
 import os
 import sqlite3
-import time
+import argparse
+import fcntl
+import hashlib
+import json
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import requests
 from dotenv import load_dotenv
+from ages import compute_ages
+from bulk_load import BulkLoader, drop_staging
+from http_cache import HTTPCache
+from migrations import BUILD_WEIGHTED_AGE_MATCHES, SCHEMA_VERSION, apply_migrations
+from mirror_images import mirror_images
+from tmdb_client import TMDBClient
+from weighted_sampling import build_alias_tables
 
 # Load environment variables from .env
 load_dotenv()
 
 # Configuration
 API_KEY = os.getenv('API_KEY')
-BASE_URL = 'https://api.themoviedb.org/3'
+BASE_URL = os.getenv('TMDB_BASE_URL', 'https://api.themoviedb.org/3')
 DB_PATH = os.path.join(os.path.abspath(
     os.path.dirname(__file__)), 'instance', 'moviedata.db')
-REQUEST_DELAY = 1  # delay in seconds
+REQUESTS_PER_SECOND = 20  # shared across all workers, TMDB allows ~50
+MAX_WORKERS = 8  # concurrent requests in flight
 BATCH_SIZE = 20  # save incremental updates after N actors
+STALE_AFTER_DAYS = 7  # refetch actors last fetched longer ago than this
 
 # Setup logging
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
-# SQLite Setup
-conn = sqlite3.connect(DB_PATH)
-cursor = conn.cursor()
+# SQLite Setup, pointed at the next snapshot by open_snapshot()
+conn = None
+cursor = None
+snapshot_lock = None  # held while this process builds the next snapshot
+
+# TMDB client with pooled connections, rate limiting, retries and a disk cache
+tmdb = TMDBClient(API_KEY, BASE_URL, REQUESTS_PER_SECOND, MAX_WORKERS,
+                  cache=HTTPCache())
+
+
+class SnapshotError(Exception):
+    '''Raised when a freshly built snapshot fails validation.'''
+
+
+def snapshot_path():
+    '''The snapshot is built next to the live database, then swapped in.'''
+    return f'{DB_PATH}.next'
+
+
+def live_identity():
+    '''Identify the live database file, so a snapshot knows what it was copied from.'''
+    if not os.path.exists(DB_PATH):
+        return None
+    stat = os.stat(DB_PATH)
+    source = sqlite3.connect(f'file:{DB_PATH}?mode=ro', uri=True)
+    try:
+        data_version = source.execute(
+            "SELECT value FROM app_meta WHERE key = 'data_version'").fetchone()
+    except sqlite3.OperationalError:
+        data_version = None
+    finally:
+        source.close()
+    return {'inode': stat.st_ino, 'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size,
+            'data_version': data_version[0] if data_version else None}
+
+
+def discard_snapshot():
+    '''Remove a snapshot and its owner record.'''
+    for suffix in ('', '-wal', '-shm', '.owner'):
+        if os.path.exists(snapshot_path() + suffix):
+            os.remove(snapshot_path() + suffix)
+
+
+def open_snapshot(kind='refresh'):
+    '''Start the next snapshot as a copy of the live database, or resume one.
+
+    Only a snapshot left by the same kind of run, copied from the live database
+    as it is now, is resumed; anything else is discarded and copied afresh.
+    Returns True if an unfinished snapshot was resumed.
+    '''
+    global conn, cursor, snapshot_lock
+    next_path = snapshot_path()
+    snapshot_lock = open(f'{next_path}.lock', 'w', encoding='utf-8')
+    try:
+        fcntl.flock(snapshot_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError as e:
+        snapshot_lock.close()
+        snapshot_lock = None
+        raise SnapshotError(f'another run is building {next_path}') from e
+
+    owner = {'kind': kind, 'live': live_identity()}
+    resumed = False
+    if os.path.exists(next_path):
+        try:
+            with open(f'{next_path}.owner', 'r', encoding='utf-8') as file:
+                previous = json.load(file)
+        except (OSError, ValueError):
+            previous = None
+        resumed = previous == owner
+        if resumed:
+            logging.info("Resuming unfinished %s snapshot %s", kind, next_path)
+        else:
+            logging.warning("Discarding snapshot %s left by another kind of run or "
+                            "copied from an older database: %s", next_path, previous)
+            discard_snapshot()
+
+    if not os.path.exists(next_path):
+        if owner['live']:
+            # the backup API copies consistently while the app keeps reading
+            logging.info("Copying %s to %s", DB_PATH, next_path)
+            source = sqlite3.connect(f'file:{DB_PATH}?mode=ro', uri=True)
+            target = sqlite3.connect(next_path)
+            source.backup(target)
+            target.close()
+            source.close()
+        # written once the copy is complete, so a half-made copy is never resumed
+        with open(f'{next_path}.owner', 'w', encoding='utf-8') as file:
+            json.dump(owner, file)
+    conn = sqlite3.connect(next_path)
+    conn.execute('PRAGMA journal_mode=WAL')  # cheaper commits while building
+    cursor = conn.cursor()
+    return resumed
+
+
+def validate_snapshot():
+    '''Refuse to publish a snapshot that is corrupt, unmigrated or empty.'''
+    integrity = cursor.execute('PRAGMA integrity_check').fetchone()[0]
+    if integrity != 'ok':
+        raise SnapshotError(f'integrity check failed: {integrity}')
+    version = cursor.execute(
+        "SELECT value FROM app_meta WHERE key = 'schema_version'").fetchone()
+    if not version or int(version[0]) != SCHEMA_VERSION:
+        raise SnapshotError(f'schema version {version} is not {SCHEMA_VERSION}')
+    for table in ('actors', 'movies', 'roles', 'age_matches'):
+        if not cursor.execute(f'SELECT 1 FROM {table} LIMIT 1').fetchone():
+            raise SnapshotError(f'{table} is empty')
+
+
+def publish_snapshot():
+    '''Fold the snapshot into a single file and atomically replace the live database.'''
+    global conn, cursor, snapshot_lock
+    cursor.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    # readers get a self-contained file with no -wal or -shm beside it
+    cursor.execute('PRAGMA journal_mode=DELETE')
+    conn.close()
+    conn = cursor = None
+    os.replace(snapshot_path(), DB_PATH)
+    os.remove(f'{snapshot_path()}.owner')
+    snapshot_lock.close()  # releases the lock
+    snapshot_lock = None
+    logging.info("Published new snapshot to %s", DB_PATH)
 
 
 def create_tables():
@@ -55,7 +185,14 @@ def create_tables():
                    FOREIGN KEY (movie_id) REFERENCES movies(id)
                    )
     ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS app_meta (
+                   key TEXT PRIMARY KEY,
+                   value TEXT
+                   )
+    ''')
     conn.commit()
+    apply_migrations(conn)
 
 
 def clear_tables():
@@ -63,74 +200,182 @@ def clear_tables():
     cursor.execute('DELETE FROM roles')
     cursor.execute('DELETE FROM movies')
     cursor.execute('DELETE FROM actors')
+    cursor.execute('DELETE FROM fetch_state')
+    drop_staging(cursor)
+    conn.commit()
+
+
+def load_actor_popularity(path='popular_actors.txt'):
+    '''Read actor IDs to keep, with their average export popularity where listed.'''
+    popularity = {}
+    with open(path, 'r', encoding='utf-8') as file:
+        for line in file:
+            fields = line.split()
+            if fields:
+                popularity[int(fields[0])] = float(fields[1]) if len(fields) > 1 else None
+    return popularity
+
+
+def update_actor_popularity(popularity):
+    '''Store each actor's export popularity, which moves even when details do not.'''
+    with conn:
+        cursor.executemany('UPDATE actors SET popularity = ? WHERE id = ?',
+                           [(value, actor_id) for actor_id, value in popularity.items()
+                            if value is not None])
+
+
+def prune_actors(actor_ids):
+    '''Remove actors no longer on the list, and their roles, in one transaction.'''
+    with conn:
+        cursor.execute(
+            'CREATE TEMP TABLE IF NOT EXISTS wanted_actors (id INTEGER PRIMARY KEY)')
+        cursor.execute('DELETE FROM wanted_actors')
+        cursor.executemany('INSERT OR IGNORE INTO wanted_actors VALUES (?)',
+                           [(actor_id,) for actor_id in actor_ids])
+        cursor.execute(
+            'DELETE FROM roles WHERE actor_id NOT IN (SELECT id FROM wanted_actors)')
+        pruned = cursor.execute(
+            'DELETE FROM actors WHERE id NOT IN (SELECT id FROM wanted_actors)').rowcount
+        cursor.execute(
+            'DELETE FROM fetch_state WHERE actor_id NOT IN (SELECT id FROM wanted_actors)')
+        cursor.execute(
+            'DELETE FROM movies WHERE id NOT IN (SELECT movie_id FROM roles)')
+    logging.info("Pruned %d actors no longer on the list.", pruned)
+
+
+def select_actors_to_fetch(actor_ids):
+    '''Keep only actors that are new or were last fetched too long ago.'''
+    stale_before = (datetime.now(timezone.utc) -
+                    timedelta(days=STALE_AFTER_DAYS)).isoformat(timespec='seconds')
+    last_fetched = dict(cursor.execute(
+        'SELECT actor_id, last_fetched FROM fetch_state'))
+    return [actor_id for actor_id in actor_ids
+            if last_fetched.get(actor_id, '') < stale_before]
+
+
+def build_age_matches():
+    '''Rebuild the denormalized age_matches table the web app reads from.'''
+    with conn:
+        cursor.execute('DELETE FROM age_matches')
+        cursor.execute(BUILD_WEIGHTED_AGE_MATCHES)
+    # weighted picks in the web app read these alias tables
+    logging.info("Built %d age matches.", build_alias_tables(conn))
+
+
+def recompute_ages():
+    '''Recompute every role's actor_age from stored dates, without calling TMDB.'''
+    rows = cursor.execute('''
+    SELECT r.id, r.actor_age, a.birthdate, m.release_date
+    FROM roles r
+    JOIN actors a ON a.id = r.actor_id
+    JOIN movies m ON m.id = r.movie_id
+    ''').fetchall()
+    ages = compute_ages([row[2] for row in rows], [row[3] for row in rows])
+    changed = [(age, role_id) for (role_id, old_age, _, _), age in zip(rows, ages)
+               if age != old_age]
+    with conn:
+        cursor.executemany('UPDATE roles SET actor_age = ? WHERE id = ?', changed)
+    logging.info("Recomputed %d ages, %d changed.", len(rows), len(changed))
+    return len(changed)
+
+
+def bump_data_version():
+    '''Mark the data as changed so running web workers rebuild their caches.'''
+    cursor.execute('''
+    INSERT INTO app_meta (key, value) VALUES ('data_version', '1')
+    ON CONFLICT (key) DO UPDATE SET value = CAST(value AS INTEGER) + 1
+    ''')
     conn.commit()
 
 
 def fetch_actor_details(person_id):
-    '''Get biographical data for given actor.'''
-    url = f'{BASE_URL}/person/{person_id}'
-    params = {'api_key': API_KEY}
+    '''Get biographical data for given actor, with movie credits appended.'''
     try:
-        response = requests.get(url, params=params, timeout=10)
-        response.raise_for_status()
-        time.sleep(REQUEST_DELAY)  # Sleep after each request
-        return response.json()
+        return tmdb.get(f'/person/{person_id}',
+                        append_to_response='movie_credits')
     except requests.exceptions.RequestException as e:
         logging.error(
             "Failed to fetch details for person ID %s: %s", person_id, e)
         return {}
 
 
-def fetch_movie_credits(person_id):
-    '''Get movie credit data for given actor.'''
-    url = f'{BASE_URL}/person/{person_id}/movie_credits'
-    params = {'api_key': API_KEY}
+def fetch_movie_credits(person_id, actor_details=None):
+    '''Get movie credit data for given actor, reusing appended credits if present.'''
+    if actor_details and 'movie_credits' in actor_details:
+        return actor_details['movie_credits']
     try:
-        response = requests.get(url, params=params, timeout=10)
-        response.raise_for_status()
-        time.sleep(REQUEST_DELAY)  # Sleep after each request
-        return response.json()
+        return tmdb.get(f'/person/{person_id}/movie_credits')
     except requests.exceptions.RequestException as e:
         logging.error(
             "Failed to fetch movie credits for person ID %s: %s", person_id, e)
         return {}
 
 
-def calculate_age(birthdate, release_date):
-    '''Calculate age of actor given birthdate and release date of movie.'''
-    if not birthdate or not release_date:
-        return None
-    try:
-        birth_dt = datetime.strptime(birthdate, '%Y-%m-%d')
-        release_dt = datetime.strptime(release_date, '%Y-%m-%d')
-        age = release_dt.year - birth_dt.year - \
-            ((release_dt.month, release_dt.day) < (birth_dt.month, birth_dt.day))
-        return age
-    except ValueError:
-        return None
+def build_roles(credits):
+    '''Turn (actor_id, movie_id, birthdate, release_date) credits into role rows in one pass.'''
+    ages = compute_ages([credit[2] for credit in credits],
+                        [credit[3] for credit in credits])
+    return [(actor_id, movie_id, age)
+            for (actor_id, movie_id, _, _), age in zip(credits, ages) if age is not None]
+
 
+def content_hash(actor_details):
+    '''Hash an API response so unchanged actors can be skipped.'''
+    payload = json.dumps(actor_details, sort_keys=True).encode('utf-8')
+    return hashlib.sha256(payload).hexdigest()
 
-def process_actors():
+
+def process_actors(actor_id_list):
     '''Assemble actor data for database insertion.'''
     logging.info("Reviewing list of actors...")
-    with open('popular_actors.txt', 'r', encoding='utf-8') as file:
-        actor_id_list = [line.strip() for line in file]
+    known_hashes = dict(cursor.execute(
+        'SELECT actor_id, content_hash FROM fetch_state'))
 
     actors_batch = []
     movies_batch = []
-    roles_batch = []
-    processed_movies = set()
+    credits_batch = []
+    states_batch = []
+    replaced_actors = []
+    seen_movies = set()
+    loader = BulkLoader(conn)
+
+    # fetch actor details concurrently, one request per actor
+    fetched = tmdb.map(fetch_actor_details, actor_id_list)
 
-    for idx, actor_id in enumerate(actor_id_list, start=1):
-        # get actor details
-        logging.info("Fetching data for actor ID %s...", actor_id)
-        actor_details = fetch_actor_details(actor_id)
+    for idx, (actor_id, actor_details) in enumerate(zip(actor_id_list, fetched), start=1):
+        logging.info("Fetched data for actor ID %s.", actor_id)
+
+        # save batches to database every BATCH_SIZE, checkpointing fetch_state
+        if idx % BATCH_SIZE == 0:
+            logging.info("Staging batch of size %d...", BATCH_SIZE)
+            loader.stage(actors_batch, movies_batch, build_roles(credits_batch),
+                         states_batch, replaced_actors)
+
+            # clear batches after saving
+            actors_batch.clear()
+            movies_batch.clear()
+            credits_batch.clear()
+            states_batch.clear()
+            replaced_actors.clear()
+
+        # leave failed fetches out of fetch_state so the next run retries them
+        if not actor_details:
+            continue
+
+        # record the fetch, and skip rewriting actors whose data is unchanged
+        details_hash = content_hash(actor_details)
+        fetched_at = datetime.now(timezone.utc).isoformat(timespec='seconds')
+        states_batch.append((actor_id, fetched_at, details_hash))
+        if known_hashes.get(actor_id) == details_hash:
+            logging.info("Actor ID %s is unchanged.", actor_id)
+            continue
+        replaced_actors.append((actor_id,))
 
         # skip actor if birthdate is missing or invalid
         birthdate = actor_details.get('birthday')
         if not birthdate:
             logging.info(
-                "Skipping %s, missing birthdate.", person_name)
+                "Skipping %s, missing birthdate.", actor_id)
             continue
 
         person_id = actor_details.get('id')
@@ -140,81 +385,96 @@ def process_actors():
         # append actor details to batch
         logging.info("Processing actor: %s, Birthdate: %s",
                      person_name, birthdate)
-        actors_batch.append((person_id, person_name, birthdate, profile_path))
+        actors_batch.append((person_id, person_name, birthdate, profile_path,
+                             actor_details.get('popularity')))
 
         # get movie credits for actor
-        credits_data = fetch_movie_credits(person_id)
+        credits_data = fetch_movie_credits(person_id, actor_details)
 
         for movie in credits_data.get('cast', []):
-            if movie['id'] not in processed_movies:
-                movie_release_date = movie.get('release_date')
-                if not movie_release_date:
-                    logging.info("Skipping movie, missing release date.")
-                    continue
-
-                movie_id = movie.get('id')
-                movie_title = movie.get('title')
-                movie_poster_path = movie.get('poster_path')
-
-                movies_batch.append(
-                    (movie_id, movie_title, movie_release_date, movie_poster_path))
-                processed_movies.add(movie_id)
-
-                actor_age = calculate_age(birthdate, movie_release_date)
-                if actor_age is not None:
-                    role = (None, person_id, movie_id, actor_age)
-                    roles_batch.append(role)
+            movie_release_date = movie.get('release_date')
+            if not movie_release_date:
+                logging.info("Skipping movie, missing release date.")
+                continue
+
+            # each movie is written once, but every actor in it gets a role
+            movie_id = movie.get('id')
+            if movie_id not in seen_movies:
+                seen_movies.add(movie_id)
+                movies_batch.append((movie_id, movie.get('title'), movie_release_date,
+                                     movie.get('poster_path'), movie.get('popularity')))
+
+            # ages are worked out for the whole batch when it is staged
+            credits_batch.append(
+                (person_id, movie_id, birthdate, movie_release_date))
 
         logging.info("Done processing %s and their movies.", person_name)
 
-        # save batches to database every BATCH_SIZE
-        if idx % BATCH_SIZE == 0:
-            logging.info("Saving batch of size %d...", BATCH_SIZE)
-            save_batch(actors_batch, movies_batch, roles_batch)
-
-            # clear batches after saving
-            actors_batch.clear()
-            movies_batch.clear()
-            roles_batch.clear()
-
-    # save remaining data after loop
-    if actors_batch or movies_batch or roles_batch:
+    # stage remaining data after loop, then merge everything at once
+    if states_batch:
         logging.info("Saving final batch...")
-        save_batch(actors_batch, movies_batch, roles_batch)
+        loader.stage(actors_batch, movies_batch, build_roles(credits_batch),
+                     states_batch, replaced_actors)
+    loader.merge()
 
     return True
 
 
-def save_batch(actors_batch, movies_batch, roles_batch):
-    '''Save actor, movie, and role data for insertion.'''
-    logging.info("Batch inserting actors...")
-    batch_insert('actors', actors_batch)
-
-    logging.info("Batch inserting movies...")
-    batch_insert('movies', movies_batch)
-
-    logging.info("Batch inserting roles...")
-    batch_insert('roles', roles_batch)
-
-
-def batch_insert(table, data):
-    '''Insert data to database in batches.'''
-    if data:
-        placeholders = ', '.join(['?' for _ in data[0]])
-        query = f'INSERT OR REPLACE INTO {
-            table} VALUES ({placeholders})'
-        cursor.executemany(query, data)
-        conn.commit()
-
-
 def main():
     '''Program to grab data from TMDB API and insert into local database for web app.'''
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--full', action='store_true',
+                        help='clear all tables and refetch every actor')
+    parser.add_argument('--offline', action='store_true',
+                        help='serve every TMDB response from the HTTP cache')
+    parser.add_argument('--recompute-ages', action='store_true',
+                        help='only recompute ages from stored dates and republish')
+    parser.add_argument('--mirror-images', action='store_true',
+                        help='mirror headshots and posters into the local media store')
+    args = parser.parse_args()
+    tmdb.cache.offline = args.offline
+
+    logging.info("Opening snapshot...")
+    if args.recompute_ages:
+        resumed = open_snapshot('recompute-ages')
+    else:
+        resumed = open_snapshot('full' if args.full else 'refresh')
     logging.info("Creating tables...")
     create_tables()
-    logging.info("Clearing tables...")
-    clear_tables()
-    logging.info("Fetching all popular actors...")
-    process_actors()
+    if args.recompute_ages:
+        recompute_ages()
+        build_age_matches()
+        bump_data_version()
+        validate_snapshot()
+        publish_snapshot()
+        logging.info("Age recompute complete!")
+        return
+
+    popularity = load_actor_popularity()
+    actor_ids = list(popularity)
+    if args.full and resumed:
+        # cleared when this run started; fetch_state and staging are its progress
+        logging.info("Resuming full refresh...")
+    elif args.full:
+        logging.info("Clearing tables...")
+        clear_tables()
+    else:
+        logging.info("Pruning actors...")
+        prune_actors(actor_ids)
+    to_fetch = select_actors_to_fetch(actor_ids)
+    logging.info("Fetching %d new or stale actors of %d...",
+                 len(to_fetch), len(actor_ids))
+    process_actors(to_fetch)
+    update_actor_popularity(popularity)
+    build_age_matches()
+    if args.mirror_images:
+        logging.info("Mirroring images...")
+        mirror_images(conn)
+    bump_data_version()
+    logging.info("Validating snapshot...")
+    validate_snapshot()
+    publish_snapshot()
+    tmdb.cache.evict()
     logging.info("Data refresh complete!")
 
 
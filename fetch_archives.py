@@ -2,12 +2,17 @@
 import os
 import logging
 import gzip
-import shutil
+import heapq
 import json
-from collections import defaultdict
+import re
+import time
+import argparse
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 import requests
+from http_cache import HTTPCache, CacheMiss
 
 # Load environment variables from .env
 load_dotenv()
@@ -23,6 +28,17 @@ REQUEST_DELAY = 3  # delay in seconds
 
 NUMBER_OF_ACTORS = 1000
 POPULARITY_CUTOFF = 20.0
+EXPORT_CACHE_TTL = 90 * 24 * 60 * 60  # dated exports never change
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # 1MB chunks
+DOWNLOAD_ATTEMPTS = 5  # tries per export, resuming where the last one stopped
+DOWNLOAD_TIMEOUT = 30  # seconds without data before a try is abandoned
+PROGRESS_INTERVAL = 2  # seconds between progress reports
+
+PARSE_WORKERS = os.cpu_count() or 1  # processes parsing export chunks
+PARSE_CHUNK_SIZE = 8 * 1024 * 1024  # bytes of export lines per work item
+# read popularity without decoding the whole record
+POPULARITY_PATTERN = re.compile(rb'"popularity":\s*([-+0-9.eE]+)')
 
 
 # Setup logging
@@ -51,164 +67,245 @@ def generate_export_filenames():
     return filenames
 
 
-def download_file_with_progress(filenames):
-    '''Download files from provided URL'''
-    downloads = []
-
+class DownloadError(Exception):
+    '''Raised when an export cannot be downloaded intact.'''
+
+
+class DownloadProgress:
+    '''Combined progress of concurrent downloads, logged at most every PROGRESS_INTERVAL.'''
+
+    def __init__(self):
+        self.sizes = {}
+        self.lock = threading.Lock()
+        self.reported_at = 0.0
+
+    def update(self, url, downloaded, total):
+        '''Record bytes downloaded for url and report if enough time has passed.'''
+        with self.lock:
+            self.sizes[url] = (downloaded, total)
+            if time.monotonic() - self.reported_at < PROGRESS_INTERVAL:
+                return
+        self.report()
+
+    def report(self):
+        '''Log combined progress now.'''
+        with self.lock:
+            self.reported_at = time.monotonic()
+            done = sum(size for size, _ in self.sizes.values())
+            expected = sum(total for _, total in self.sizes.values())
+        logging.info("Download progress: %.1f of %.1f MB",
+                     done / 1024 ** 2, expected / 1024 ** 2)
+
+
+def expected_size(response, offset):
+    '''Work out the full file size from a 200 or 206 response.'''
+    content_range = response.headers.get('content-range', '')
+    if '/' in content_range and not content_range.endswith('/*'):
+        return int(content_range.rsplit('/', 1)[1])
+    length = response.headers.get('content-length')
+    if length is None:
+        return None
+    return int(length) + (offset if response.status_code == 206 else 0)
+
+
+def verify_gzip(path):
+    '''Read a gzip file to the end so its CRC and length are checked.'''
+    try:
+        with gzip.open(path, 'rb') as file:
+            while file.read(DOWNLOAD_CHUNK_SIZE):
+                pass
+        return True
+    except (OSError, EOFError) as e:
+        logging.error("Corrupt archive %s: %s", path, e)
+        return False
+
+
+def download_export(url, session, progress):
+    '''Download one export to a .part file, resuming with Range requests.'''
+    dest_file = url.replace(DAILY_EXPORT_URL, '')
+    part_path = os.path.join(ARCHIVE_DIR, f'{dest_file}.part')
+
+    for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+        try:
+            with session.get(url, headers=headers, stream=True,
+                             timeout=DOWNLOAD_TIMEOUT) as response:
+                if response.status_code == 416:
+                    # nothing left to fetch, or a stale part file
+                    total_size = expected_size(response, offset)
+                    if total_size != offset:
+                        os.remove(part_path)
+                        continue
+                else:
+                    response.raise_for_status()
+                    if response.status_code != 206:
+                        offset = 0  # server ignored the Range header
+                    total_size = expected_size(response, offset)
+
+                    if offset:
+                        logging.info("Resuming %s at byte %d", url, offset)
+                    else:
+                        logging.info("Starting download: %s", url)
+                    downloaded_size = offset
+                    with open(part_path, 'ab' if offset else 'wb') as output_file:
+                        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                            output_file.write(chunk)
+                            downloaded_size += len(chunk)
+                            progress.update(url, downloaded_size, total_size or 0)
+        except requests.exceptions.RequestException as e:
+            logging.warning("Download of %s failed on try %d: %s", url, attempt, e)
+            time.sleep(2 ** attempt)
+            continue
+
+        # verify download before anything downstream sees it
+        downloaded_size = os.path.getsize(part_path)
+        if total_size is not None and downloaded_size < total_size:
+            logging.warning("Download of %s truncated on try %d: %s of %s bytes",
+                            url, attempt, downloaded_size, total_size)
+            time.sleep(2 ** attempt)
+            continue
+        if (total_size is not None and downloaded_size > total_size) or \
+                not verify_gzip(part_path):
+            logging.warning("Discarding bad download of %s on try %d", url, attempt)
+            os.remove(part_path)
+            continue
+        logging.info("Download verified: %s", url)
+        return part_path
+
+    raise DownloadError(f'Could not download {url} after {DOWNLOAD_ATTEMPTS} tries')
+
+
+def download_file_with_progress(filenames, cache):
+    '''Download files from provided URL into the cache, returning cached paths'''
     if not os.path.exists(ARCHIVE_DIR):
         os.makedirs(ARCHIVE_DIR)
 
+    downloads = {}
+    missing = []
     for url in filenames:
-        dest_file = url.replace(DAILY_EXPORT_URL, '').replace('.gz', '')
-        output_path = f'{ARCHIVE_DIR}/{dest_file}.gz'
-
-        with requests.get(url, stream=True, timeout=7) as response:
-            response.raise_for_status()
-            total_size = int(response.headers.get('content-length', 0))
-            chunk_size = 1024  # 1KB chunks
-
-            with open(output_path, 'wb') as output_file:
-                logging.info("Starting download: %s", url)
-
-                downloaded_size = 0
-                for chunk in response.iter_content(chunk_size=chunk_size):
-                    if chunk:
-                        output_file.write(chunk)
-                        downloaded_size += len(chunk)
-
-                        # print progress
-                        progress = (downloaded_size / total_size) * 100
-                        print(f"\rDownload progress: {progress:.2f}%", end='')
-                logging.info("\nDownload complete")
-
-        # verify download
-        if downloaded_size == total_size:
-            logging.info("Download verified")
+        cached_path = cache.lookup(url)
+        if cached_path:
+            logging.info("Using cached copy of %s", url)
+            downloads[url] = cached_path
+        elif cache.offline:
+            raise CacheMiss(f'{url} is not cached')
         else:
-            logging.error("Download incomplete. %s of %s downloaded.",
-                          downloaded_size, total_size)
-
-        downloads.append(output_path)
-
+            missing.append(url)
+
+    # fetch every missing export at once over one pooled session
+    progress = DownloadProgress()
+    with requests.Session() as session, \
+            ThreadPoolExecutor(max_workers=max(len(missing), 1)) as executor:
+        futures = {url: executor.submit(download_export, url, session, progress)
+                   for url in missing}
+        for url, future in futures.items():
+            downloads[url] = cache.store_file(
+                url, None, future.result(), EXPORT_CACHE_TTL)
+    if missing:
+        progress.report()
+
+    downloads = [downloads[url] for url in filenames]
     logging.info(downloads)
     return downloads
 
 
-def unzip_archives(downloads):
-    '''Unzip relevant files with validation.'''
-    unzipped_archives = []
-
-    for file in downloads:
-        # designate where to save
-        new_file_name = os.path.basename(file).replace('.gz', '')
-        archive_path = os.path.join(ARCHIVE_DIR, new_file_name)
-
+def read_chunks(file_name):
+    '''Yield blocks of whole lines from a gzip export.'''
+    logging.info("Streaming popular people from %s...", file_name)
+    try:
+        with gzip.open(file_name, 'rb') as file:
+            leftover = b''
+            while True:
+                block = file.read(PARSE_CHUNK_SIZE)
+                if not block:
+                    break
+                block = leftover + block
+                cut = block.rfind(b'\n') + 1
+                leftover = block[cut:]
+                if cut:
+                    yield block[:cut]
+            if leftover:
+                yield leftover
+    except (OSError, EOFError) as e:
+        logging.error("Failed to read %s: %s", file_name, e)
+
+
+def sum_chunk(chunk):
+    '''Total popularity per person in a block of export lines.'''
+    sums = {}
+    for match in POPULARITY_PATTERN.finditer(chunk):
+        # cheap prefilter: most people are below the cutoff
         try:
-            # decompress the file
-            logging.info("Decompressing %s to %s...", file, archive_path)
-
-            with gzip.open(file, 'rb') as gz_file:
-                with open(archive_path, 'wb') as output_file:
-                    shutil.copyfileobj(gz_file, output_file)
-
-            if os.path.getsize(archive_path) == 0:
-                logging.error(
-                    "Unzipped file %s is empty, skipping.", archive_path)
-                os.remove(archive_path)
-            else:
-                logging.info("Decompressed %s.", file)
-                unzipped_archives.append(archive_path)
-
-        except OSError as e:
-            logging.error("Failed to unzip %s: %s", file, e)
-
-    return unzipped_archives
-
-
-def filter_and_combine(filenames):
-    '''Filter and combine JSON data using streaming.'''
-    combined_data = []
-    logging.info(
-        "Streaming popular people into one combined file, please hold...")
-    for file_name in filenames:
-        with open(file_name, 'r', encoding='utf-8') as file:
-            for line in file:
-                try:
-                    record = json.loads(line)
-                    if record['popularity'] >= POPULARITY_CUTOFF:
-                        combined_data.append(record)
-                except json.JSONDecodeError as e:
-                    logging.error(
-                        "Error decoding JSON in %s: %s", file_name, e)
-    logging.info("Finished filtering and combining data.")
-    return combined_data
-
-# TODO: experiment with writing directly to output instead of holding in memory:
-# maybe define a 'whatever.json' output name and return that if it's not empty
-# def filter_and_combine_to_file(filenames, output_file):
-#     '''Filter and combine JSON data directly into an output file.'''
-#     logging.info(
-#         "Streaming popular actors into one combined file, please hold...")
-#     with open(output_file, 'w', encoding='utf-8') as outfile:
-#         for file_name in filenames:
-#             with open(file_name, 'r', encoding='utf-8') as file:
-#                 for line in file:
-#                     try:
-#                         record = json.loads(line)
-#                         if record['popularity'] >= POPULARITY_CUTOFF:
-#                             outfile.write(json.dumps(record) + '\n')
-#                     except json.JSONDecodeError as e:
-#                         logging.error(
-#                             "Error decoding JSON in %s: %s", file_name, e)
-#     logging.info("Finished filtering and combining data.")
-
-
-def calculate_average_popularity(data):
-    '''Calculate average popularity across exported months.'''
-    popularity_dict = defaultdict(list)
-
-    # collect popularity values for each ID
-    logging.info("Calculating average popularity for actors...")
-    for record in data:
-        popularity_dict[record['id']].append(record['popularity'])
-
-    # calculate average popularity for each ID
-    average_popularity = []
-    for actor_id, popularities in popularity_dict.items():
-        # assume 0 if missing to penalize less popular people
-        avg_pop = sum(popularities) / NUMBER_OF_EXPORTS
-        average_popularity.append(
-            {'id': actor_id, 'average_popularity': avg_pop})
-
-    logging.info("Writing average popularity data to output file...")
-    with open('archives/average_popularity.json', 'w', encoding='utf-8') as output_file:
-        for entry in average_popularity:
-            json.dump(entry, output_file)
-            output_file.write('\n')
+            if float(match.group(1)) < POPULARITY_CUTOFF:
+                continue
+        except ValueError:
+            continue
+
+        # only decode the lines that pass
+        start = chunk.rfind(b'\n', 0, match.start()) + 1
+        end = chunk.find(b'\n', match.end())
+        line = chunk[start:end] if end != -1 else chunk[start:]
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            logging.error("Error decoding JSON: %s", e)
+            continue
+        sums[record['id']] = sums.get(record['id'], 0.0) + record['popularity']
+    return sums
+
+
+def merge_sums(popularity_sums, partial):
+    '''Fold one chunk's totals into the running totals.'''
+    for person_id, popularity in partial.items():
+        popularity_sums[person_id] = popularity_sums.get(
+            person_id, 0.0) + popularity
+
+
+def sum_popularity(filenames, workers=PARSE_WORKERS):
+    '''Keep a running popularity total per person across all exports.'''
+    popularity_sums = {}
+    chunks = (chunk for file_name in filenames
+              for chunk in read_chunks(file_name))
+
+    if workers <= 1:
+        for chunk in chunks:
+            merge_sums(popularity_sums, sum_chunk(chunk))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # keep a couple of chunks per worker in flight to bound memory
+            pending = set()
+            for chunk in chunks:
+                pending.add(executor.submit(sum_chunk, chunk))
+                if len(pending) >= workers * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        merge_sums(popularity_sums, future.result())
+            for future in wait(pending).done:
+                merge_sums(popularity_sums, future.result())
+
+    logging.info("Found %d popular people.", len(popularity_sums))
+    return popularity_sums
+
+
+def select_popular_actors(popularity_sums, output_file):
+    '''Write the IDs of the most popular actors with their average popularity.'''
+    logging.info("Filtering actors by their popularity...")
+    # bounded heap, so only NUMBER_OF_ACTORS entries are ever sorted
+    top_actors = heapq.nlargest(NUMBER_OF_ACTORS, popularity_sums.items(),
+                                key=lambda item: item[1])
 
+    # assume 0 if missing to penalize less popular people
+    average_popularity = [(actor_id, total / NUMBER_OF_EXPORTS)
+                          for actor_id, total in top_actors]
     print("Printing sample for average_popularity...")
     print(average_popularity[:5])
 
-
-def select_popular_actors(input_file, output_file):
-    '''Filter for most popular actors.'''
-    # load average_popularity data
-    logging.info("Filtering actors by their popularity...")
-    with open(input_file, 'r', encoding='utf-8') as file:
-        data = [json.loads(line) for line in file]
-
-    # sort popularity in descending order
-    sorted_data = sorted(
-        data, key=lambda x: x['average_popularity'], reverse=True)
-
-    # trim to most popular and grab their ID
-    top_actors = sorted_data[:NUMBER_OF_ACTORS]
-    popular_actor_ids = [str(actor['id']) for actor in top_actors]
-
-    # save IDs to text file
+    # save IDs and popularity to text file, used to weight matches on the site
     logging.info("Writing list of most popular actors...")
     with open(output_file, 'w', encoding='utf-8') as outfile:
-        outfile.write('\n'.join(popular_actor_ids))
+        outfile.write('\n'.join(f'{actor_id}\t{popularity:.3f}'
+                      for actor_id, popularity in average_popularity))
     logging.info("Completed saving the %s most popular actors.",
                  NUMBER_OF_ACTORS)
 
@@ -222,14 +319,27 @@ def cleanup_temp_files():
     logging.info("Don't for get to clean up!")
 
 
-print("----------START----------")
-archives_to_fetch = generate_export_filenames()
-downloaded_archives = download_file_with_progress(archives_to_fetch)
-unzipped_files = unzip_archives(downloaded_archives)
-combined_archives = filter_and_combine(unzipped_files)
-calculate_average_popularity(combined_archives)
-select_popular_actors('archives/average_popularity.json', 'popular_actors.txt')
-cleanup_temp_files()
-print("--------------------")
-print("TMDB archive download complete. Actors list ready for processing. Don't forget to clean up!")
-print("----------END----------")
+def main():
+    '''Fetch TMDB person exports and write the most popular actor IDs.'''
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--offline', action='store_true',
+                        help='serve every export from the HTTP cache')
+    parser.add_argument('--workers', type=int, default=PARSE_WORKERS,
+                        help='processes used to parse the exports')
+    args = parser.parse_args()
+    cache = HTTPCache(offline=args.offline)
+
+    print("----------START----------")
+    archives_to_fetch = generate_export_filenames()
+    downloaded_archives = download_file_with_progress(archives_to_fetch, cache)
+    popularity_sums = sum_popularity(downloaded_archives, args.workers)
+    select_popular_actors(popularity_sums, 'popular_actors.txt')
+    cleanup_temp_files()
+    cache.evict()
+    print("--------------------")
+    print("TMDB archive download complete. Actors list ready for processing. Don't forget to clean up!")
+    print("----------END----------")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+'''Parsed-document cache and persisted queries for GraphQL execution.'''
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from functools import partial
+from graphql import parse, validate
+from graphql.backend.base import GraphQLBackend, GraphQLDocument
+from graphql.execution import ExecutionResult, execute
+from graphql_server import HttpQueryError
+
+DOCUMENT_CACHE_SIZE = 256  # distinct parsed and validated documents kept
+PERSISTED_QUERY_LIMIT = 1024  # client-registered persisted queries kept
+
+
+def execute_invalid(errors, *args, **kwargs):
+    '''Stand-in execute for documents that failed validation.'''
+    return ExecutionResult(errors=errors, invalid=True)
+
+
+class LRUDocumentBackend(GraphQLBackend):
+    '''Parse and validate each distinct query string once, keeping the most recent.'''
+
+    def __init__(self, max_size=DOCUMENT_CACHE_SIZE):
+        self.max_size = max_size
+        self.documents = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def document_from_string(self, schema, document_string):
+        key = (schema, document_string)
+        with self.lock:
+            document = self.documents.get(key)
+            if document is not None:
+                self.documents.move_to_end(key)
+                self.hits += 1
+                return document
+            self.misses += 1
+
+        # syntax errors raise here and are reported by the caller, uncached
+        document_ast = parse(document_string)
+        errors = validate(schema, document_ast)
+        if errors:
+            run = partial(execute_invalid, errors)
+        else:
+            run = partial(execute, schema, document_ast)
+        document = GraphQLDocument(schema, document_string, document_ast, run)
+
+        with self.lock:
+            self.documents[key] = document
+            if len(self.documents) > self.max_size:
+                self.documents.popitem(last=False)
+        return document
+
+
+class PersistedQueries:
+    '''Map SHA-256 hashes to query text so clients can send a hash instead.
+
+    Follows the automatic persisted query convention: a request carries
+    extensions.persistedQuery.sha256Hash, and may register its query text by
+    sending it alongside the hash once.
+    '''
+
+    def __init__(self, limit=PERSISTED_QUERY_LIMIT):
+        self.limit = limit
+        self.pinned = {}
+        self.registered = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def query_hash(query):
+        '''Return the hex SHA-256 of a query string.'''
+        return hashlib.sha256(query.encode('utf-8')).hexdigest()
+
+    def pin(self, query):
+        '''Persist one of the app's own queries permanently, returning its hash.'''
+        query_hash = self.query_hash(query)
+        self.pinned[query_hash] = query
+        return query_hash
+
+    def lookup(self, query_hash):
+        '''Return the query text for a hash, or None.'''
+        with self.lock:
+            query = self.pinned.get(query_hash) or self.registered.get(query_hash)
+            if query_hash in self.registered:
+                self.registered.move_to_end(query_hash)
+            return query
+
+    def register(self, query_hash, query):
+        '''Remember a client query under its hash, after checking the hash matches.'''
+        if self.query_hash(query) != query_hash:
+            raise HttpQueryError(400, 'provided sha does not match query')
+        with self.lock:
+            self.registered[query_hash] = query
+            if len(self.registered) > self.limit:
+                self.registered.popitem(last=False)
+
+    def resolve(self, data, query_data):
+        '''Fill in the query text of a request that only names a persisted query.'''
+        extensions = data.get('extensions') or query_data.get('extensions')
+        if isinstance(extensions, str):
+            try:
+                extensions = json.loads(extensions)
+            except ValueError:
+                raise HttpQueryError(400, 'Extensions are invalid JSON.')
+        persisted = (extensions or {}).get('persistedQuery')
+        if not persisted:
+            return data
+
+        query_hash = persisted.get('sha256Hash')
+        query = data.get('query') or query_data.get('query')
+        if query:
+            self.register(query_hash, query)
+            return data
+
+        query = self.lookup(query_hash)
+        if query is None:
+            raise HttpQueryError(400, 'PersistedQueryNotFound')
+        data = dict(data)
+        data['query'] = query
+        return data
@@ -0,0 +1,21 @@
+'''Gunicorn settings, read automatically by the Procfile's `gunicorn app:app`.'''
+import os
+
+# import and warm the app once in the master, workers share it copy-on-write
+preload_app = os.getenv('PRELOAD_APP', '1') == '1'
+workers = int(os.getenv('WEB_CONCURRENCY', '2'))
+
+
+def when_ready(server):
+    if not preload_app:
+        return
+    import app
+    seconds = app.warmup()
+    server.log.info("App imported in %.0fms, warmed up in %.0fms",
+                    app.IMPORT_SECONDS * 1000, seconds * 1000)
+
+
+def post_fork(server, worker):
+    if preload_app:
+        import app
+        app.after_fork()
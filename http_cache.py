@@ -0,0 +1,153 @@
+'''Content-addressed on-disk cache for TMDB API responses and export files.'''
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from urllib.parse import urlencode
+import requests
+
+CACHE_DIR = os.getenv('HTTP_CACHE_DIR', os.path.join(
+    os.path.abspath(os.path.dirname(__file__)), 'http_cache'))
+DEFAULT_TTL = 24 * 60 * 60  # seconds before a cached response is refetched
+MAX_CACHE_BYTES = 4 * 1024 ** 3  # evict least recently used entries past this
+CHUNK_SIZE = 1024 * 1024  # bytes hashed per read
+
+
+class CacheMiss(requests.exceptions.RequestException):
+    '''Raised in offline mode when a response is not in the cache.'''
+
+
+class HTTPCache:
+    '''Map request URLs to response bodies stored once by their SHA-256.
+
+    index/<request hash>.json points at blobs/<aa>/<content hash>; identical
+    bodies fetched from different URLs share one blob.
+    '''
+
+    def __init__(self, root=CACHE_DIR, ttl=DEFAULT_TTL, max_bytes=MAX_CACHE_BYTES,
+                 offline=False):
+        self.root = root
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.offline = offline
+        os.makedirs(os.path.join(root, 'index'), exist_ok=True)
+        os.makedirs(os.path.join(root, 'blobs'), exist_ok=True)
+
+    def _index_path(self, url, params):
+        # api keys never take part in the cache key
+        query = urlencode(sorted((k, v) for k, v in (params or {}).items()
+                                 if k != 'api_key'))
+        request_hash = hashlib.sha256(f'{url}?{query}'.encode('utf-8')).hexdigest()
+        return os.path.join(self.root, 'index', f'{request_hash}.json')
+
+    def _blob_path(self, content_hash):
+        return os.path.join(self.root, 'blobs', content_hash[:2], content_hash)
+
+    def lookup(self, url, params=None):
+        '''Return the cached body path for a request, or None if missing or expired.'''
+        index_path = self._index_path(url, params)
+        try:
+            with open(index_path, 'r', encoding='utf-8') as file:
+                entry = json.load(file)
+        except (OSError, ValueError):
+            return None
+
+        # offline replay serves whatever is cached, however old
+        if not self.offline and time.time() > entry['expires_at']:
+            return None
+
+        blob_path = self._blob_path(entry['content_hash'])
+        if not os.path.exists(blob_path):
+            return None
+        os.utime(index_path)  # mark as recently used
+        return blob_path
+
+    def get_json(self, url, params=None):
+        '''Return a cached JSON response, or None.'''
+        blob_path = self.lookup(url, params)
+        if blob_path is None:
+            return None
+        with open(blob_path, 'rb') as file:
+            return json.loads(file.read())
+
+    def store_bytes(self, url, params, body, ttl=None):
+        '''Cache a response body held in memory.'''
+        fd, tmp_path = tempfile.mkstemp(dir=self.root)
+        with os.fdopen(fd, 'wb') as file:
+            file.write(body)
+        return self.store_file(url, params, tmp_path, ttl)
+
+    def store_file(self, url, params, src_path, ttl=None):
+        '''Move a downloaded file into the cache and index it under the request.'''
+        digest = hashlib.sha256()
+        size = 0
+        with open(src_path, 'rb') as file:
+            for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+                size += len(chunk)
+        content_hash = digest.hexdigest()
+
+        blob_path = self._blob_path(content_hash)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        if os.path.exists(blob_path):
+            os.remove(src_path)
+        else:
+            shutil.move(src_path, blob_path)
+
+        ttl = self.ttl if ttl is None else ttl
+        entry = {'url': url, 'content_hash': content_hash,
+                 'size': size, 'expires_at': time.time() + ttl}
+        fd, tmp_path = tempfile.mkstemp(dir=self.root)
+        with os.fdopen(fd, 'w', encoding='utf-8') as file:
+            json.dump(entry, file)
+        os.replace(tmp_path, self._index_path(url, params))
+        return blob_path
+
+    def evict(self):
+        '''Drop least recently used entries until under max_bytes, expired ones first.
+
+        Expired entries are otherwise kept: an online run refetches and replaces
+        them, and until then they are what an offline replay serves. Offline
+        runs add nothing, so they evict nothing.
+        '''
+        if self.offline:
+            return
+        index_dir = os.path.join(self.root, 'index')
+        entries = []
+        for name in os.listdir(index_dir):
+            path = os.path.join(index_dir, name)
+            try:
+                with open(path, 'r', encoding='utf-8') as file:
+                    entry = json.load(file)
+                entries.append((os.path.getmtime(path), path, entry))
+            except (OSError, ValueError):
+                os.remove(path)
+
+        # fresh before expired, each newest first, so the least useful fall off the end
+        now = time.time()
+        entries.sort(key=lambda item: (now <= item[2]['expires_at'], item[0]), reverse=True)
+        kept_blobs = set()
+        total = 0
+        removed = 0
+        for _used_at, path, entry in entries:
+            content_hash = entry['content_hash']
+            new_blob = content_hash not in kept_blobs
+            if new_blob and total + entry['size'] > self.max_bytes:
+                os.remove(path)
+                removed += 1
+                continue
+            if new_blob:
+                kept_blobs.add(content_hash)
+                total += entry['size']
+
+        # remove blobs no index entry points at any more
+        blob_dir = os.path.join(self.root, 'blobs')
+        for prefix in os.listdir(blob_dir):
+            for name in os.listdir(os.path.join(blob_dir, prefix)):
+                if name not in kept_blobs:
+                    os.remove(os.path.join(blob_dir, prefix, name))
+        logging.info("HTTP cache holds %d bytes after evicting %d entries.",
+                     total, removed)
@@ -0,0 +1,18 @@
+'''In-memory map of TMDB image paths to locally mirrored files.'''
+from data_version import VersionedIndex
+from models import MirroredImage
+
+
+class ImageIndex(VersionedIndex):
+    '''Know which image paths mirror_images.py has stored, reloaded when the data version moves.'''
+
+    def __init__(self, watcher):
+        super().__init__(watcher)
+        self._files = {}
+
+    def load(self, session):
+        self._files = dict(session.query(MirroredImage.path, MirroredImage.file_name))
+
+    def file_name(self, path):
+        '''The mirrored file for an image path, or None if it is not mirrored.'''
+        return self._files.get(path)
@@ -0,0 +1,63 @@
+'''Per-request DataLoaders that batch relationship lookups in the GraphQL schema.'''
+import sqlalchemy
+from promise import Promise
+from promise.dataloader import DataLoader
+from query_cost import CappedBatchConnectionField
+
+MAX_BATCH_SIZE = 500  # keys per IN (...) query
+
+
+class ColumnLoader(DataLoader):
+    '''Load rows of a model whose column matches any key, one IN query per batch.'''
+
+    def __init__(self, session, model, column, many):
+        super().__init__(max_batch_size=MAX_BATCH_SIZE)
+        self.session = session
+        self.model = model
+        self.column = column
+        self.many = many
+
+    def batch_load_fn(self, keys):  # pylint: disable=method-hidden
+        rows = self.session.query(self.model) \
+            .filter(self.column.in_(keys)) \
+            .order_by(*self.model.__mapper__.primary_key)
+
+        # group rows back under the key that asked for them
+        found = {key: [] for key in keys}
+        for row in rows:
+            found[getattr(row, self.column.key)].append(row)
+
+        if self.many:
+            return Promise.resolve([found[key] for key in keys])
+        return Promise.resolve([found[key][0] if found[key] else None for key in keys])
+
+
+def get_loader(context, relationship):
+    '''Return this request's loader for a relationship, creating it on first use.'''
+    loaders = context.setdefault('loaders', {})
+    loader = loaders.get(relationship)
+    if loader is None:
+        (_local, remote), = relationship.local_remote_pairs
+        loader = ColumnLoader(context['session'], relationship.mapper.class_,
+                              remote, relationship.uselist)
+        loaders[relationship] = loader
+    return loader
+
+
+def batched_resolver(key):
+    '''Build a resolver that loads the named relationship through a DataLoader.'''
+    def resolve(root, info, **args):
+        relationship = sqlalchemy.inspect(type(root)).relationships[key]
+        (local, _remote), = relationship.local_remote_pairs
+        value = getattr(root, relationship.parent.get_property_by_column(local).key)
+        if value is None:
+            return [] if relationship.uselist else None
+        return get_loader(info.context, relationship).load(value)
+    return resolve
+
+
+def batched_connection_field_factory(relationship, registry, **field_kwargs):
+    '''Expose a one-to-many relationship as a connection backed by a DataLoader.'''
+    model_type = registry.get_type_for_model(relationship.mapper.entity)
+    return CappedBatchConnectionField(
+        model_type.connection, resolver=batched_resolver(relationship.key), **field_kwargs)
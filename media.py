@@ -0,0 +1,10 @@
+'''Where mirrored images live, shared by mirror_images.py and the web app.'''
+import os
+
+MEDIA_DIR = os.getenv('MEDIA_DIR', os.path.join(
+    os.path.abspath(os.path.dirname(__file__)), 'instance', 'media'))
+
+
+def media_path(file_name, root=MEDIA_DIR):
+    '''Where a stored file lives, fanned out by the first two characters of its hash.'''
+    return os.path.join(root, file_name[:2], file_name)
@@ -0,0 +1,219 @@
+'''In-process request, resolver, SQL and cache metrics in the Prometheus text format.'''
+import logging
+import os
+import random
+import threading
+import time
+from bisect import bisect_left
+from flask import before_render_template, g, has_app_context, request, template_rendered
+from graphql import GraphQLList, GraphQLNonNull, GraphQLObjectType
+from graphql.backend.base import GraphQLBackend, GraphQLDocument
+from sqlalchemy import event
+
+# upper bounds in seconds; +Inf is implied
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# log requests slower than this many milliseconds, unset to disable
+SLOW_REQUEST_MS = float(os.getenv('SLOW_REQUEST_MS', '0')) or None
+SLOW_REQUEST_SAMPLE_RATE = float(os.getenv('SLOW_REQUEST_SAMPLE_RATE', '1.0'))
+
+HELP = {
+    'moviepeers_request_seconds': ('histogram', 'Time spent handling HTTP requests.'),
+    'moviepeers_resolver_seconds': ('histogram', 'Time spent in GraphQL object field resolvers.'),
+    'moviepeers_graphql_parse_seconds': ('histogram', 'Time spent looking up or parsing GraphQL documents.'),
+    'moviepeers_graphql_execute_seconds': ('histogram', 'Time spent executing GraphQL documents.'),
+    'moviepeers_template_seconds': ('histogram', 'Time spent rendering templates.'),
+    'moviepeers_sql_seconds': ('histogram', 'Time spent executing SQL statements.'),
+    'moviepeers_cache_hits_total': ('counter', 'Cache lookups answered from the cache.'),
+    'moviepeers_cache_misses_total': ('counter', 'Cache lookups that had to compute a value.'),
+}
+
+
+def span(name, seconds):
+    '''Add time to the current request's span breakdown, reported in the slow request log.'''
+    if has_app_context() and 'spans' in g:
+        total, count = g.spans.get(name, (0.0, 0))
+        g.spans[name] = (total + seconds, count + 1)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                     for name, value in labels)
+    return '{' + pairs + '}'
+
+
+class Metrics:
+    '''Histograms kept per worker process, plus counters read from caches at scrape time.
+
+    Nothing is shared between processes: under gunicorn with several workers,
+    each scrape reports only the worker that happened to answer it.
+    '''
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.histograms = {}
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def observe(self, name, seconds, **labels):
+        '''Record one duration in a histogram.'''
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            counts = self.histograms.get(key)
+            if counts is None:
+                # one slot per bucket, +Inf, then the running sum
+                counts = self.histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect_left(self.buckets, seconds)] += 1
+            counts[-1] += seconds
+
+    def reset(self):
+        '''Forget every observation, e.g. those made while warming up.'''
+        with self.lock:
+            self.histograms.clear()
+
+    def collect(self, fn):
+        '''Register fn returning [(name, labels dict, value)] to be read on every scrape.'''
+        self.collectors.append(fn)
+        return fn
+
+    def render(self):
+        '''Every metric in the Prometheus text exposition format.'''
+        samples = {}
+        with self.lock:
+            for (name, labels), counts in sorted(self.histograms.items()):
+                lines = samples.setdefault(name, [])
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{format_labels(labels + (("le", bound),))} {cumulative}')
+                lines.append(f'{name}_sum{format_labels(labels)} {counts[-1]:.6f}')
+                lines.append(f'{name}_count{format_labels(labels)} {cumulative}')
+        for fn in self.collectors:
+            for name, labels, value in fn():
+                samples.setdefault(name, []).append(
+                    f'{name}{format_labels(tuple(sorted(labels.items())))} {value}')
+
+        output = []
+        for name, lines in samples.items():
+            kind, description = HELP.get(name, ('untyped', ''))
+            output.append(f'# HELP {name} {description}')
+            output.append(f'# TYPE {name} {kind}')
+            output.extend(lines)
+        return '\n'.join(output) + '\n'
+
+
+def cache_collector(caches):
+    '''Report hits and misses of objects with hits/misses attributes, keyed by cache name.'''
+    def collect():
+        for cache_name, cache in caches.items():
+            yield 'moviepeers_cache_hits_total', {'cache': cache_name}, cache.hits
+            yield 'moviepeers_cache_misses_total', {'cache': cache_name}, cache.misses
+    return collect
+
+
+def instrument_engine(engine, metrics):
+    '''Time every SQL statement the engine runs, labelled by statement verb.'''
+    # the start time lives on the execution context, which is thrown away with
+    # the statement, so a statement that raises leaves nothing behind
+    @event.listens_for(engine, 'before_cursor_execute')
+    def start_statement(conn, cursor, statement, parameters, context, executemany):
+        context._query_start = time.perf_counter()  # pylint: disable=protected-access
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def end_statement(conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - context._query_start  # pylint: disable=protected-access
+        verb = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else 'OTHER'
+        metrics.observe('moviepeers_sql_seconds', seconds, statement=verb)
+        span('sql', seconds)
+
+
+class ResolverTimingMiddleware:
+    '''Graphene middleware timing resolvers of object-typed fields.
+
+    Scalar fields use the default attribute resolver and are left untimed, which
+    keeps the overhead off the many leaf fields of a large result. Batched
+    resolvers return a promise, so their time is the time to schedule the load;
+    the batch's SQL shows up under moviepeers_sql_seconds.
+    '''
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def resolve(self, next_resolver, root, info, **args):
+        return_type = info.return_type
+        while isinstance(return_type, (GraphQLList, GraphQLNonNull)):
+            return_type = return_type.of_type
+        if not isinstance(return_type, GraphQLObjectType):
+            return next_resolver(root, info, **args)
+
+        start = time.perf_counter()
+        try:
+            return next_resolver(root, info, **args)
+        finally:
+            seconds = time.perf_counter() - start
+            self.metrics.observe('moviepeers_resolver_seconds', seconds,
+                                 field=f'{info.parent_type.name}.{info.field_name}')
+            span('resolve', seconds)
+
+
+class TimedBackend(GraphQLBackend):
+    '''Wrap a document backend to time document lookup and execution.'''
+
+    def __init__(self, backend, metrics):
+        self.backend = backend
+        self.metrics = metrics
+
+    def document_from_string(self, schema, document_string):
+        start = time.perf_counter()
+        document = self.backend.document_from_string(schema, document_string)
+        seconds = time.perf_counter() - start
+        self.metrics.observe('moviepeers_graphql_parse_seconds', seconds)
+        span('graphql_parse', seconds)
+
+        def execute(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return document.execute(*args, **kwargs)
+            finally:
+                seconds = time.perf_counter() - start
+                self.metrics.observe('moviepeers_graphql_execute_seconds', seconds)
+                span('graphql_execute', seconds)
+
+        return GraphQLDocument(schema, document_string, document.document_ast, execute)
+
+
+def instrument_app(app, metrics):
+    '''Time requests and template rendering, and log sampled slow requests.'''
+    @app.before_request
+    def start_request():
+        g.request_start = time.perf_counter()
+        g.spans = {}
+
+    @before_render_template.connect_via(app)
+    def start_render(sender, template, context, **extra):
+        g.render_start = time.perf_counter()
+
+    @template_rendered.connect_via(app)
+    def end_render(sender, template, context, **extra):
+        seconds = time.perf_counter() - g.pop('render_start', time.perf_counter())
+        metrics.observe('moviepeers_template_seconds', seconds, template=template.name)
+        span('render', seconds)
+
+    @app.after_request
+    def end_request(response):
+        if 'request_start' not in g:
+            return response
+        seconds = time.perf_counter() - g.request_start
+        endpoint = request.endpoint or 'unmatched'
+        metrics.observe('moviepeers_request_seconds', seconds, endpoint=endpoint,
+                        method=request.method, status=response.status_code)
+        if SLOW_REQUEST_MS and seconds * 1000 >= SLOW_REQUEST_MS and \
+                random.random() < SLOW_REQUEST_SAMPLE_RATE:
+            breakdown = ' '.join(f'{name}={total * 1000:.1f}ms/{count}'
+                                 for name, (total, count) in sorted(g.spans.items()))
+            logging.warning("Slow request %s %s %d in %.1fms: %s", request.method,
+                            request.full_path.rstrip('?'), response.status_code,
+                            seconds * 1000, breakdown or 'no spans')
+        return response
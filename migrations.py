@@ -0,0 +1,208 @@
+'''Versioned schema migrations shared by the data pipeline and the web app.'''
+import logging
+import os
+import sqlite3
+import sys
+
+# denormalized matches, dense 0-based ordinals per age, clustered by age
+BUILD_AGE_MATCHES = '''
+INSERT INTO age_matches (age, ordinal, actor_name, image_path, movie_title, poster_path)
+SELECT r.actor_age,
+       ROW_NUMBER() OVER (PARTITION BY r.actor_age
+                          ORDER BY r.actor_id, r.movie_id) - 1,
+       a.actor_name, a.image_path, m.movie_title, m.poster_path
+FROM roles r
+JOIN actors a ON a.id = r.actor_id
+JOIN movies m ON m.id = r.movie_id
+WHERE r.actor_age IS NOT NULL
+'''
+
+# as above, weighting each match by how well known its actor and movie are
+BUILD_WEIGHTED_AGE_MATCHES = '''
+INSERT INTO age_matches (age, ordinal, actor_name, image_path, movie_title, poster_path,
+                         weight, role_id)
+SELECT r.actor_age,
+       ROW_NUMBER() OVER (PARTITION BY r.actor_age
+                          ORDER BY r.actor_id, r.movie_id) - 1,
+       a.actor_name, a.image_path, m.movie_title, m.poster_path,
+       MAX(COALESCE(a.popularity, 1.0), 0.1) * MAX(COALESCE(m.popularity, 1.0), 0.1),
+       r.id
+FROM roles r
+JOIN actors a ON a.id = r.actor_id
+JOIN movies m ON m.id = r.movie_id
+WHERE r.actor_age IS NOT NULL
+'''
+
+# (version, description, statements) -- append new migrations, never edit old ones
+MIGRATIONS = [
+    (1, 'index roles for age lookups, one role per actor and movie', [
+        '''DELETE FROM roles WHERE id NOT IN (
+               SELECT MIN(id) FROM roles GROUP BY actor_id, movie_id)''',
+        '''CREATE UNIQUE INDEX IF NOT EXISTS uq_roles_actor_movie
+               ON roles (actor_id, movie_id)''',
+        '''CREATE INDEX IF NOT EXISTS ix_roles_age_actor_movie
+               ON roles (actor_age, actor_id, movie_id)''',
+        '''CREATE INDEX IF NOT EXISTS ix_roles_movie_id
+               ON roles (movie_id)''',
+    ]),
+    (2, 'track per-actor fetch state for incremental refreshes', [
+        '''CREATE TABLE IF NOT EXISTS fetch_state (
+               actor_id INTEGER PRIMARY KEY,
+               last_fetched TEXT NOT NULL,
+               content_hash TEXT NOT NULL)''',
+    ]),
+    (3, 'add the denormalized age_matches serving table', [
+        '''CREATE TABLE IF NOT EXISTS age_matches (
+               age INTEGER NOT NULL,
+               ordinal INTEGER NOT NULL,
+               actor_name TEXT NOT NULL,
+               image_path TEXT,
+               movie_title TEXT NOT NULL,
+               poster_path TEXT,
+               PRIMARY KEY (age, ordinal)) WITHOUT ROWID''',
+        'DELETE FROM age_matches',
+        BUILD_AGE_MATCHES,
+    ]),
+    (4, 'carry popularity through and weight age_matches with alias tables', [
+        'ALTER TABLE actors ADD COLUMN popularity REAL',
+        'ALTER TABLE movies ADD COLUMN popularity REAL',
+        'ALTER TABLE age_matches ADD COLUMN weight REAL',
+        'ALTER TABLE age_matches ADD COLUMN alias_prob REAL',
+        'ALTER TABLE age_matches ADD COLUMN alias_ordinal INTEGER',
+    ]),
+    (5, 'map TMDB image paths to locally mirrored files', [
+        '''CREATE TABLE IF NOT EXISTS mirrored_images (
+               path TEXT PRIMARY KEY,
+               file_name TEXT NOT NULL,
+               bytes INTEGER
+           ) WITHOUT ROWID''',
+    ]),
+    (6, 'point each age match at its role so randomRole can sample by ordinal', [
+        'ALTER TABLE age_matches ADD COLUMN role_id INTEGER',
+        # the same numbering the builders use, for tables built before this
+        '''UPDATE age_matches SET role_id = numbered.id
+           FROM (SELECT r.id, r.actor_age,
+                        ROW_NUMBER() OVER (PARTITION BY r.actor_age
+                                           ORDER BY r.actor_id, r.movie_id) - 1 AS ordinal
+                 FROM roles r
+                 JOIN actors a ON a.id = r.actor_id
+                 JOIN movies m ON m.id = r.movie_id
+                 WHERE r.actor_age IS NOT NULL) AS numbered
+           WHERE numbered.actor_age = age_matches.age
+             AND numbered.ordinal = age_matches.ordinal''',
+    ]),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+# queries the web app runs on every request, used for the query-plan check
+HOT_QUERIES = {
+    'randomRole size': 'SELECT MAX(ordinal) FROM age_matches WHERE age = 30',
+    'randomRole sample': '''SELECT roles.* FROM roles
+                            JOIN age_matches ON age_matches.role_id = roles.id
+                            WHERE age_matches.age = 30
+                            AND age_matches.ordinal IN (3, 1, 4)''',
+    'roles by age': 'SELECT * FROM roles WHERE actor_age = 30 LIMIT 100',
+    'roles by age range after cursor': '''SELECT * FROM roles
+                            WHERE (actor_age, actor_id, movie_id) > (29, 10, 5)
+                            AND actor_age <= 32
+                            ORDER BY actor_age, actor_id, movie_id LIMIT 100''',
+    'roles by actor': 'SELECT * FROM roles WHERE actor_id IN (1, 2, 3) ORDER BY id',
+    'roles by movie': 'SELECT * FROM roles WHERE movie_id IN (1, 2, 3) ORDER BY id',
+    'age match': 'SELECT * FROM age_matches WHERE age = 30 AND ordinal = 10',
+    'age match alias': '''SELECT alias_prob, alias_ordinal, actor_name FROM age_matches
+                          WHERE age = 30 AND ordinal = 10''',
+    'age match counts': 'SELECT age, COUNT(*) FROM age_matches GROUP BY age',
+}
+
+
+def get_schema_version(conn):
+    '''Return the schema version recorded in the database, 0 if none.'''
+    cursor = conn.cursor()
+    cursor.execute(
+        'CREATE TABLE IF NOT EXISTS app_meta (key TEXT PRIMARY KEY, value TEXT)')
+    cursor.execute("SELECT value FROM app_meta WHERE key = 'schema_version'")
+    row = cursor.fetchone()
+    return int(row[0]) if row else 0
+
+
+def schema_is_current(conn):
+    '''True if the database is already at SCHEMA_VERSION, checked without any DDL.'''
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT value FROM app_meta WHERE key = 'schema_version'")
+    except sqlite3.OperationalError:
+        return False  # no app_meta table yet
+    row = cursor.fetchone()
+    return bool(row) and int(row[0]) >= SCHEMA_VERSION
+
+
+def execute_statement(cursor, statement):
+    '''Run one migration statement, skipping columns create_all() already made.'''
+    try:
+        cursor.execute(statement)
+    except sqlite3.OperationalError as e:
+        if 'ADD COLUMN' not in statement or 'duplicate column name' not in str(e):
+            raise
+
+
+def apply_migrations(conn):
+    '''Bring a DB-API connection up to SCHEMA_VERSION, one transaction per step.'''
+    current = get_schema_version(conn)
+    conn.commit()
+    cursor = conn.cursor()
+    for version, description, statements in MIGRATIONS:
+        if version <= current:
+            continue
+        logging.info("Applying migration %s: %s", version, description)
+        try:
+            for statement in statements:
+                execute_statement(cursor, statement)
+            cursor.execute('''
+            INSERT INTO app_meta (key, value) VALUES ('schema_version', ?)
+            ON CONFLICT (key) DO UPDATE SET value = excluded.value
+            ''', (str(version),))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        current = version
+    return current
+
+
+def explain_hot_queries(conn):
+    '''Return the SQLite query plan for each hot web query.'''
+    cursor = conn.cursor()
+    plans = {}
+    for name, query in HOT_QUERIES.items():
+        try:
+            cursor.execute(f'EXPLAIN QUERY PLAN {query}')
+        except sqlite3.OperationalError as e:
+            plans[name] = [str(e)]  # table added by a later migration
+            continue
+        plans[name] = [row[-1] for row in cursor.fetchall()]
+    return plans
+
+
+def print_plans(label, plans):
+    '''Print query plans under a heading.'''
+    print(f"--- {label} ---")
+    for name, steps in plans.items():
+        print(f"{name}: {'; '.join(steps)}")
+
+
+def main():
+    '''Migrate a database and show the hot query plans before and after.'''
+    db_path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(
+        os.path.abspath(os.path.dirname(__file__)), 'instance', 'moviedata.db')
+    conn = sqlite3.connect(db_path)
+    print_plans(f"before (schema version {get_schema_version(conn)})",
+                explain_hot_queries(conn))
+    version = apply_migrations(conn)
+    print_plans(f"after (schema version {version})", explain_hot_queries(conn))
+    conn.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
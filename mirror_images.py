@@ -0,0 +1,146 @@
+'''Mirror actor headshots and movie posters into a local content-addressed store.'''
+import os
+import argparse
+import hashlib
+import logging
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+import requests
+from requests.adapters import HTTPAdapter
+from PIL import Image
+from media import MEDIA_DIR, media_path
+
+# Configuration
+# fetched larger than shown, then scaled down to THUMBNAIL_WIDTH
+IMAGE_BASE_URL = os.getenv('IMAGE_BASE_URL', 'https://image.tmdb.org/t/p/w342')
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', '8'))  # downloads in flight
+IMAGE_TIMEOUT = 30  # seconds per download
+THUMBNAIL_WIDTH = 185  # pixels, the width the home page shows
+THUMBNAIL_QUALITY = 80  # JPEG quality of generated thumbnails
+
+# every image the home page can show
+WANTED_PATHS = '''
+SELECT image_path FROM age_matches WHERE image_path IS NOT NULL
+UNION
+SELECT poster_path FROM age_matches WHERE poster_path IS NOT NULL
+'''
+
+
+def make_thumbnail(body):
+    '''Scale an image down to THUMBNAIL_WIDTH and re-encode it as a compact JPEG.'''
+    try:
+        with Image.open(BytesIO(body)) as image:
+            image = image.convert('RGB')
+            # the height bound is loose, the width is what matters
+            image.thumbnail((THUMBNAIL_WIDTH, THUMBNAIL_WIDTH * 10))
+            output = BytesIO()
+            image.save(output, 'JPEG', quality=THUMBNAIL_QUALITY,
+                       optimize=True, progressive=True)
+    except (OSError, ValueError) as e:
+        # Image.open raises a subclass of OSError for data it cannot decode
+        raise ValueError(f'cannot make a thumbnail: {e}') from e
+    return output.getvalue()
+
+
+class ImageMirror:
+    '''Download image paths concurrently and store each distinct body once.
+
+    Files are named by the SHA-256 of what is stored, so identical images
+    reached through different paths, or through actors and movies alike,
+    share one file, and a file never changes once written.
+    '''
+
+    def __init__(self, base_url=IMAGE_BASE_URL, root=MEDIA_DIR, workers=IMAGE_WORKERS):
+        self.base_url = base_url.rstrip('/')
+        self.root = root
+        self.workers = workers
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def store(self, body, extension):
+        '''Write body under its content hash unless already there; return (file_name, size).'''
+        file_name = hashlib.sha256(body).hexdigest() + extension
+        path = media_path(file_name, self.root)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # readers only ever see a complete file
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, 'wb') as file:
+                file.write(body)
+            os.replace(tmp_path, path)
+        return file_name, len(body)
+
+    def fetch(self, path):
+        '''Mirror one image path; return (path, file_name, size), or None if it failed.'''
+        try:
+            response = self.session.get(self.base_url + path, timeout=IMAGE_TIMEOUT)
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            logging.warning("Could not mirror %s: %s", path, e)
+            return None
+
+        try:
+            thumbnail = make_thumbnail(response.content)
+        except ValueError as e:
+            logging.warning("Not mirroring %s: %s", path, e)
+            return None
+        return (path,) + self.store(thumbnail, '.jpg')
+
+    def mirror(self, paths):
+        '''Mirror paths concurrently, returning the ones that succeeded.'''
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return [result for result in executor.map(self.fetch, paths) if result]
+
+
+def mirror_images(conn, mirror=None):
+    '''Mirror every image age_matches can show that is not mirrored yet, then record them.'''
+    mirror = mirror or ImageMirror()
+    cursor = conn.cursor()
+    wanted = [path for (path,) in cursor.execute(WANTED_PATHS)]
+    known = dict(cursor.execute('SELECT path, file_name FROM mirrored_images'))
+    # also refetch anything whose file has gone missing from the store
+    missing = [path for path in wanted if path not in known or
+               not os.path.exists(media_path(known[path], mirror.root))]
+
+    start = time.perf_counter()
+    mirrored = mirror.mirror(missing)
+    with conn:
+        cursor.execute(f'DELETE FROM mirrored_images WHERE path NOT IN ({WANTED_PATHS})')
+        cursor.executemany('''
+            INSERT INTO mirrored_images (path, file_name, bytes) VALUES (?, ?, ?)
+            ON CONFLICT (path) DO UPDATE SET
+                file_name = excluded.file_name,
+                bytes = excluded.bytes''', mirrored)
+    logging.info("Mirrored %d of %d missing images in %.1fs (%d files, %d bytes); "
+                 "%d already mirrored.", len(mirrored), len(missing),
+                 time.perf_counter() - start, len({row[1] for row in mirrored}),
+                 sum(row[2] for row in mirrored), len(wanted) - len(missing))
+    return len(mirrored)
+
+
+def main():
+    '''Mirror home page images into MEDIA_DIR and publish the mapping in a new snapshot.'''
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--base-url', default=IMAGE_BASE_URL,
+                        help='image server prefix that TMDB image paths are appended to')
+    parser.add_argument('--workers', type=int, default=IMAGE_WORKERS,
+                        help='concurrent downloads')
+    args = parser.parse_args()
+
+    # pylint: disable=import-outside-toplevel
+    import fetch_actor_data as pipeline  # reuse its snapshot handling
+    pipeline.open_snapshot('mirror-images')
+    pipeline.create_tables()
+    mirror_images(pipeline.conn, ImageMirror(args.base_url, workers=args.workers))
+    pipeline.bump_data_version()
+    pipeline.validate_snapshot()
+    pipeline.publish_snapshot()
+    logging.info("Image mirror complete!")
+
+
+if __name__ == '__main__':
+    main()
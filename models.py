@@ -9,6 +9,7 @@ class Actor(db.Model):
     actor_name = db.Column(db.String, nullable=False)
     birthdate = db.Column(db.String, nullable=False)
     image_path = db.Column(db.String)
+    popularity = db.Column(db.Float)
 
 
 class Movie(db.Model):
@@ -17,10 +18,18 @@ class Movie(db.Model):
     movie_title = db.Column(db.String, nullable=False)
     release_date = db.Column(db.String, nullable=False)
     poster_path = db.Column(db.String)
+    popularity = db.Column(db.Float)
 
 
 class Role(db.Model):
     __tablename__ = 'roles'
+    # kept in step with migrations.py for databases created by create_all()
+    __table_args__ = (
+        db.Index('uq_roles_actor_movie', 'actor_id', 'movie_id', unique=True),
+        db.Index('ix_roles_age_actor_movie',
+                 'actor_age', 'actor_id', 'movie_id'),
+        db.Index('ix_roles_movie_id', 'movie_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     actor_id = db.Column(db.Integer, db.ForeignKey('actors.id'))
     movie_id = db.Column(db.Integer, db.ForeignKey('movies.id'))
@@ -29,3 +38,35 @@ class Role(db.Model):
         'Actor', backref=db.backref('roles', lazy='dynamic'))
     movie = db.relationship(
         'Movie', backref=db.backref('roles', lazy='dynamic'))
+
+
+class AppMeta(db.Model):
+    __tablename__ = 'app_meta'
+    key = db.Column(db.String, primary_key=True)
+    value = db.Column(db.String)
+
+
+class AgeMatch(db.Model):
+    __tablename__ = 'age_matches'
+    # built by the pipeline from roles, actors and movies; see migrations.py
+    __table_args__ = {'sqlite_with_rowid': False}
+    age = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    ordinal = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    actor_name = db.Column(db.String, nullable=False)
+    image_path = db.Column(db.String)
+    movie_title = db.Column(db.String, nullable=False)
+    poster_path = db.Column(db.String)
+    # Walker alias table over weight, one per age; see weighted_sampling.py
+    weight = db.Column(db.Float)
+    alias_prob = db.Column(db.Float)
+    alias_ordinal = db.Column(db.Integer)
+    role_id = db.Column(db.Integer)
+
+
+class MirroredImage(db.Model):
+    __tablename__ = 'mirrored_images'
+    # filled by mirror_images.py; file_name is the content hash plus extension
+    __table_args__ = {'sqlite_with_rowid': False}
+    path = db.Column(db.String, primary_key=True)
+    file_name = db.Column(db.String, nullable=False)
+    bytes = db.Column(db.Integer)
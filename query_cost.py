@@ -0,0 +1,282 @@
+'''Reject expensive GraphQL queries before they execute, and cap connection page sizes.'''
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from flask import g
+from graphene_sqlalchemy import SQLAlchemyConnectionField
+from graphene_sqlalchemy.fields import BatchSQLAlchemyConnectionField
+from graphql import GraphQLError, GraphQLList, GraphQLNonNull
+from graphql.backend.base import GraphQLBackend, GraphQLDocument
+from graphql.execution import ExecutionResult
+from graphql.language import ast
+
+CONNECTION_DEFAULT_FIRST = 50  # edges returned when a connection gets no first or last
+CONNECTION_MAX_FIRST = 200  # hard cap on first and last
+
+QUERY_MAX_DEPTH = int(os.getenv('QUERY_MAX_DEPTH', '10'))
+QUERY_MAX_COST = int(os.getenv('QUERY_MAX_COST', '5000'))
+CLIENT_COST_PER_MINUTE = int(os.getenv('CLIENT_COST_PER_MINUTE', '50000'))
+CLIENT_LIMIT = 10000  # clients tracked per worker, least recently seen dropped first
+
+# arguments that say how many items a list field returns
+SIZE_ARGUMENTS = ('first', 'last', 'limit', 'count')
+
+
+def cap_page_args(args):
+    '''Apply the default and maximum page size to a connection's arguments.'''
+    args = dict(args)
+    if args.get('first') is None and args.get('last') is None:
+        args['first'] = CONNECTION_DEFAULT_FIRST
+    for key in ('first', 'last'):
+        if args.get(key) is not None:
+            args[key] = max(0, min(args[key], CONNECTION_MAX_FIRST))
+    return args
+
+
+class CappedConnectionField(SQLAlchemyConnectionField):
+    '''Connection field that never returns more than CONNECTION_MAX_FIRST edges.'''
+
+    @classmethod
+    def resolve_connection(cls, connection_type, model, info, args, resolved):
+        return super().resolve_connection(connection_type, model, info,
+                                          cap_page_args(args), resolved)
+
+
+class CappedBatchConnectionField(BatchSQLAlchemyConnectionField):
+    '''Batched relationship connection with the same page size caps.'''
+
+    @classmethod
+    def resolve_connection(cls, connection_type, model, info, args, resolved):
+        return super().resolve_connection(connection_type, model, info,
+                                          cap_page_args(args), resolved)
+
+
+class QueryCostError(GraphQLError):
+    '''Raised for a query that is too deep or too expensive to run.'''
+
+
+def literal_value(value):
+    '''The Python value of an integer literal, None for anything else.'''
+    if isinstance(value, ast.IntValue):
+        return int(value.value)
+    return None
+
+
+def is_connection(graphql_type):
+    return graphql_type.name.endswith('Connection') and \
+        'edges' in getattr(graphql_type, 'fields', {})
+
+
+def unwrap(graphql_type):
+    '''Strip NonNull and List wrappers, noting whether a list was among them.'''
+    is_list = False
+    while isinstance(graphql_type, (GraphQLList, GraphQLNonNull)):
+        is_list = is_list or isinstance(graphql_type, GraphQLList)
+        graphql_type = graphql_type.of_type
+    return graphql_type, is_list
+
+
+class CostAnalyzer:
+    '''Estimate a query's cost as the number of objects it can return, and its depth.
+
+    Every field costs one, and a list or connection field multiplies the cost
+    of its selection by its page size, taken from first, last, limit or count
+    with the same defaults and caps the resolvers apply. size_caps maps
+    'Type.field' to the cap its resolver puts on limit or count.
+
+    Each fragment is costed once per depth it is spread at, and the walk
+    stops with QueryCostError as soon as the cost or depth passes max_cost
+    or max_depth, so analysing a query stays cheap however it is built.
+    '''
+
+    def __init__(self, schema, document_ast, variables, size_caps=None,
+                 max_cost=None, max_depth=None):
+        self.schema = schema
+        # malformed variables fail validation later; cost them as absent
+        self.variables = variables if isinstance(variables, dict) else {}
+        self.size_caps = size_caps or {}
+        self.max_cost = max_cost
+        self.max_depth = max_depth
+        self.fragment_costs = {}
+        self.fragments = {definition.name.value: definition
+                          for definition in document_ast.definitions
+                          if isinstance(definition, ast.FragmentDefinition)}
+        self.document_ast = document_ast
+
+    def operation(self, operation_name):
+        for definition in self.document_ast.definitions:
+            if isinstance(definition, ast.OperationDefinition) and \
+                    (operation_name is None or
+                     (definition.name and definition.name.value == operation_name)):
+                return definition
+        return None
+
+    def analyze(self, operation_name=None):
+        '''Return (cost, depth) of the operation that will run.
+
+        Raises QueryCostError if it goes over max_cost or max_depth.
+        '''
+        operation = self.operation(operation_name)
+        if operation is None:
+            return 0, 0
+        root = {'query': self.schema.get_query_type(),
+                'mutation': self.schema.get_mutation_type(),
+                'subscription': self.schema.get_subscription_type()}[operation.operation]
+        # unsupplied variables take the defaults the operation declares
+        self.variables = dict(self.variables)
+        for definition in operation.variable_definitions or []:
+            name = definition.variable.name.value
+            if name not in self.variables and definition.default_value is not None:
+                self.variables[name] = literal_value(definition.default_value)
+        return self.selection_cost(operation.selection_set, root, 1, set(), 1)
+
+    def argument_value(self, node, arg_def):
+        if node is None:
+            return arg_def.default_value
+        value = node.value
+        if isinstance(value, ast.Variable):
+            value = self.variables.get(value.name.value, arg_def.default_value)
+            # Int coercion accepts numeric strings; anything else fails validation later
+            if isinstance(value, str) and value.strip().lstrip('-').isdigit():
+                return int(value)
+            if isinstance(value, bool) or not isinstance(value, int):
+                return None
+            return value
+        return literal_value(value)
+
+    def page_size(self, field_node, field_def, parent_type):
+        '''How many items a list or connection field can return.'''
+        nodes = {argument.name.value: argument for argument in field_node.arguments or []}
+        sizes = {name: self.argument_value(nodes.get(name), field_def.args[name])
+                 for name in SIZE_ARGUMENTS if name in field_def.args}
+        if 'first' in sizes or 'last' in sizes:
+            capped = cap_page_args(sizes)
+            return max(capped.get('first') or 0, capped.get('last') or 0)
+        cap = self.size_caps.get(f'{parent_type.name}.{field_node.name.value}')
+        for name in ('limit', 'count'):
+            if sizes.get(name) is not None:
+                size = max(0, sizes[name])
+                return min(size, cap) if cap is not None else size
+        return CONNECTION_MAX_FIRST if cap is None else cap
+
+    def selection_cost(self, selection_set, parent_type, depth, visited, scale):
+        '''Return (cost, depth) of a selection set on parent_type.
+
+        scale is how many times the enclosing fields multiply this selection,
+        so scale * cost is a lower bound on the whole query's cost.
+        '''
+        if self.max_depth is not None and depth > self.max_depth:
+            raise QueryCostError(f'Query depth exceeds the limit of {self.max_depth}')
+        cost = 0
+        max_depth = depth
+        for selection in selection_set.selections:
+            if isinstance(selection, ast.FragmentSpread):
+                name = selection.name.value
+                if name in visited or name not in self.fragments:
+                    continue  # cycles and unknown fragments fail validation anyway
+                if (name, depth) not in self.fragment_costs:
+                    fragment = self.fragments[name]
+                    fragment_type = self.schema.get_type(fragment.type_condition.name.value)
+                    self.fragment_costs[name, depth] = self.selection_cost(
+                        fragment.selection_set, fragment_type, depth, visited | {name}, scale)
+                child_cost, child_depth = self.fragment_costs[name, depth]
+            elif isinstance(selection, ast.InlineFragment):
+                fragment_type = parent_type
+                if selection.type_condition:
+                    fragment_type = self.schema.get_type(selection.type_condition.name.value)
+                child_cost, child_depth = self.selection_cost(
+                    selection.selection_set, fragment_type, depth, visited, scale)
+            else:
+                name = selection.name.value
+                fields = getattr(parent_type, 'fields', {})
+                if name.startswith('__') or name not in fields:
+                    continue  # introspection is free, unknown fields fail validation
+                field_def = fields[name]
+                named_type, is_list = unwrap(field_def.type)
+                size = 1
+                if name == 'edges' and is_connection(parent_type):
+                    pass  # already counted at the connection field
+                elif is_list or is_connection(named_type):
+                    size = self.page_size(selection, field_def, parent_type)
+                child_cost, child_depth = 0, depth
+                if selection.selection_set:
+                    child_cost, child_depth = self.selection_cost(
+                        selection.selection_set, named_type, depth + 1, visited, scale * size)
+                child_cost = size * (1 + child_cost)
+            cost += child_cost
+            max_depth = max(max_depth, child_depth)
+            if self.max_cost is not None and scale * cost > self.max_cost:
+                raise QueryCostError(f'Query cost exceeds the limit of {self.max_cost}')
+        return cost, max_depth
+
+
+class CostBudgets:
+    '''Per-client token buckets of query cost, refilled every minute.'''
+
+    def __init__(self, per_minute=CLIENT_COST_PER_MINUTE, limit=CLIENT_LIMIT):
+        self.per_minute = per_minute
+        self.limit = limit
+        self.clients = OrderedDict()
+        self.lock = threading.Lock()
+
+    def spend(self, client, cost):
+        '''Charge cost to client; return 0 if allowed, else seconds until it would be.'''
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.clients.pop(client, (self.per_minute, now))
+            tokens = min(self.per_minute, tokens + (now - updated) * self.per_minute / 60)
+            wait = 0.0
+            if cost > tokens:
+                wait = (cost - tokens) * 60 / self.per_minute
+            else:
+                tokens -= cost
+            self.clients[client] = (tokens, now)
+            if len(self.clients) > self.limit:
+                self.clients.popitem(last=False)
+        return wait
+
+
+class CostLimitingBackend(GraphQLBackend):
+    '''Wrap a document backend so each execution is costed and budgeted first.'''
+
+    def __init__(self, backend, budgets, get_client, max_cost=QUERY_MAX_COST,
+                 max_depth=QUERY_MAX_DEPTH, size_caps=None):
+        self.backend = backend
+        self.size_caps = size_caps
+        self.budgets = budgets
+        self.get_client = get_client
+        self.max_cost = max_cost
+        self.max_depth = max_depth
+
+    def document_from_string(self, schema, document_string):
+        document = self.backend.document_from_string(schema, document_string)
+
+        def execute(*args, **kwargs):
+            variables = kwargs.get('variable_values')
+            if variables is not None and not isinstance(variables, dict):
+                return rejected('Variables must be a JSON object')
+            analyzer = CostAnalyzer(schema, document.document_ast,
+                                    kwargs.get('variable_values'), self.size_caps,
+                                    self.max_cost, self.max_depth)
+            try:
+                cost, _ = analyzer.analyze(kwargs.get('operation_name'))
+            except QueryCostError as e:
+                return rejected(str(e))
+            except (TypeError, ValueError):
+                # never leak an internal error message to the client
+                logging.exception("Could not cost query %r", document_string)
+                return rejected('Query cost could not be estimated')
+            g.graphql_cost = cost
+            wait = self.budgets.spend(self.get_client(), cost)
+            if wait:
+                g.graphql_retry_after = wait
+                return rejected(f'Query cost budget exhausted, retry in {wait:.0f}s')
+            return document.execute(*args, **kwargs)
+
+        return GraphQLDocument(schema, document_string, document.document_ast, execute)
+
+
+def rejected(message):
+    return ExecutionResult(errors=[QueryCostError(message)], invalid=True)
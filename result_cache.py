@@ -0,0 +1,231 @@
+'''Cache GraphQL results per query, variables and data version.'''
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from graphql.backend.base import GraphQLBackend, GraphQLDocument
+from graphql.execution import ExecutionResult
+from graphql.language.printer import print_ast
+
+RESULT_CACHE_SIZE = 1024  # results kept per cache
+# set to a file path to share one result cache between gunicorn workers
+RESULT_CACHE_PATH = os.getenv('RESULT_CACHE_PATH')
+USED_AT_RESOLUTION = 60  # seconds; recency is only recorded this coarsely, to spare writes
+# fields whose results must never be reused
+UNCACHEABLE_FIELDS = {'randomRole'}
+UNSEEN = object()  # no data version observed yet
+
+
+class MemoryBackend:
+    '''In-process LRU store; each worker keeps its own.'''
+
+    def __init__(self, max_size=RESULT_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, version):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def prune(self, version):
+        # only this worker writes here, and it has moved on to version
+        with self.lock:
+            self.entries.clear()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def close(self):
+        pass
+
+    def after_fork(self):
+        pass
+
+
+class SQLiteBackend:
+    '''LRU store in a local SQLite file, shared by every worker on the machine.
+
+    Any SQLite error, such as a lock held too long by another worker, makes a
+    lookup a miss and a store a no-op rather than failing the request.
+    '''
+
+    def __init__(self, path, max_size=RESULT_CACHE_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.local = threading.local()
+        # not kept: a connection must never be carried into a forked worker
+        conn = sqlite3.connect(self.path, timeout=1)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('DROP TABLE IF EXISTS results')  # older layout without versions
+        conn.execute('''CREATE TABLE IF NOT EXISTS graphql_results (
+                            key TEXT PRIMARY KEY,
+                            value TEXT NOT NULL,
+                            version TEXT,
+                            used_at REAL NOT NULL)''')
+        conn.execute('''CREATE INDEX IF NOT EXISTS ix_graphql_results_used_at
+                            ON graphql_results (used_at)''')
+        conn.commit()
+        conn.close()
+
+    def _conn(self):
+        # sqlite connections cannot be shared across threads
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=1)
+            conn.execute('PRAGMA synchronous=OFF')
+            self.local.conn = conn
+        return conn
+
+    def _write(self, statements):
+        conn = self._conn()
+        try:
+            for statement, params in statements:
+                conn.execute(statement, params)
+            conn.commit()
+        except sqlite3.Error as e:
+            conn.rollback()
+            logging.warning("Result cache write skipped: %s", e)
+
+    def get(self, key):
+        try:
+            row = self._conn().execute(
+                'SELECT value, used_at FROM graphql_results WHERE key = ?', (key,)).fetchone()
+        except sqlite3.Error as e:
+            logging.warning("Result cache read failed: %s", e)
+            return None
+        if row is None:
+            return None
+        now = time.time()
+        if now - row[1] >= USED_AT_RESOLUTION:
+            self._write([('UPDATE graphql_results SET used_at = ? WHERE key = ?', (now, key))])
+        return json.loads(row[0])
+
+    def set(self, key, value, version):
+        self._write([
+            ('INSERT OR REPLACE INTO graphql_results VALUES (?, ?, ?, ?)',
+             (key, json.dumps(value), str(version), time.time())),
+            ('''DELETE FROM graphql_results WHERE key IN (
+                   SELECT key FROM graphql_results ORDER BY used_at DESC
+                   LIMIT -1 OFFSET ?)''', (self.max_size,)),
+        ])
+
+    def close(self):
+        '''Close the calling thread's connection; the next use opens a new one.'''
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+        self.local = threading.local()
+
+    def after_fork(self):
+        '''Drop connections inherited from the parent process without touching them.'''
+        self.local = threading.local()
+
+    def prune(self, version):
+        # other workers may already be filling the store for version; keep those
+        self._write([('DELETE FROM graphql_results WHERE version IS NOT ?', (str(version),))])
+
+    def clear(self):
+        '''Drop every result, whatever its version.'''
+        self._write([('DELETE FROM graphql_results', ())])
+
+
+def default_backend():
+    '''Share results through RESULT_CACHE_PATH if set, else keep them in process.'''
+    if RESULT_CACHE_PATH:
+        return SQLiteBackend(RESULT_CACHE_PATH)
+    return MemoryBackend()
+
+
+def is_cacheable(document_ast):
+    '''Return False if the document selects any field in UNCACHEABLE_FIELDS.'''
+    nodes = list(document_ast.definitions)
+    while nodes:
+        node = nodes.pop()
+        name = getattr(node, 'name', None)
+        if getattr(name, 'value', None) in UNCACHEABLE_FIELDS:
+            return False
+        selection_set = getattr(node, 'selection_set', None)
+        if selection_set:
+            nodes.extend(selection_set.selections)
+    return True
+
+
+class ResultCache:
+    '''Look up results by query, variables and data version; prune when the version moves.'''
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.version = UNSEEN
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(normalized_query, variables, operation_name, version):
+        '''Hash everything that decides a result into one key.'''
+        payload = json.dumps([normalized_query, variables or {}, operation_name, version],
+                             sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key, version):
+        '''Return a cached result, dropping what was cached under other versions.'''
+        if version != self.version:
+            # keys include the version, so pruning only reclaims space
+            if self.version is not UNSEEN:
+                self.backend.prune(version)
+            self.version = version
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value, version):
+        self.backend.set(key, value, version)
+
+
+class ResultCachingBackend(GraphQLBackend):
+    '''Wrap a document backend so executing a document consults the result cache.'''
+
+    def __init__(self, backend, cache, get_version):
+        self.backend = backend
+        self.cache = cache
+        self.get_version = get_version
+
+    def document_from_string(self, schema, document_string):
+        document = self.backend.document_from_string(schema, document_string)
+        if not is_cacheable(document.document_ast):
+            return document
+
+        # whitespace and comments do not change the result
+        normalized_query = print_ast(document.document_ast)
+
+        def execute(*args, **kwargs):
+            version = self.get_version()
+            key = self.cache.key(normalized_query, kwargs.get('variable_values'),
+                                 kwargs.get('operation_name'), version)
+            data = self.cache.get(key, version)
+            if data is not None:
+                return ExecutionResult(data=data)
+            result = document.execute(*args, **kwargs)
+            if not result.invalid and not result.errors:
+                self.cache.set(key, result.data, version)
+            return result
+
+        return GraphQLDocument(schema, document_string, document.document_ast, execute)
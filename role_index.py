@@ -0,0 +1,79 @@
+'''In-memory count of matches per age for the home page.'''
+import math
+import random
+from sqlalchemy import func
+from data_version import VersionedIndex
+from models import AgeMatch
+
+
+class RoleIndex(VersionedIndex):
+    '''Know how many age_matches rows each age has, so a pick is one primary-key read.'''
+
+    def __init__(self, watcher):
+        super().__init__(watcher)
+        self._counts = {}
+        self._orders = {}
+
+    def load(self, session):
+        '''Count matches per age; ordinals run densely from 0 within each age.'''
+        rows = session.query(AgeMatch.age, func.count()) \
+            .group_by(AgeMatch.age)
+        self._counts = dict(rows)
+        self._orders = {}
+
+    def order(self, session, age):
+        '''Age's ordinals in a popularity-weighted shuffle that is fixed per data version.
+
+        Weighted sampling without replacement (Efraimidis-Spirakis): each match
+        gets the key u ** (1 / weight) for a seeded uniform u, and the order is
+        by descending key. Compared as log(u) / weight, which sorts the same.
+        '''
+        ordinals = self._orders.get(age)
+        if ordinals is None:
+            rng = random.Random(f'{self._version}:{age}')
+            rows = session.query(AgeMatch.ordinal, AgeMatch.weight) \
+                .filter(AgeMatch.age == age).order_by(AgeMatch.ordinal)
+            # 1 - random() is in (0, 1], so the log is defined
+            keys = [(math.log(1.0 - rng.random()) / (weight or 1.0), ordinal)
+                    for ordinal, weight in rows]
+            keys.sort(reverse=True)
+            ordinals = self._orders[age] = [ordinal for _, ordinal in keys]
+        return ordinals
+
+    def batch(self, session, age, size, page=0):
+        '''Return a page of age's matches in their weighted shuffle.'''
+        if not self._counts.get(age):
+            return []
+        ordinals = self.order(session, age)[page * size:(page + 1) * size]
+        if not ordinals:
+            return []
+        rows = session.query(AgeMatch.ordinal, AgeMatch.actor_name, AgeMatch.image_path,
+                             AgeMatch.movie_title, AgeMatch.poster_path) \
+            .filter(AgeMatch.age == age, AgeMatch.ordinal.in_(ordinals))
+        by_ordinal = {ordinal: fields for ordinal, *fields in rows}
+        return [by_ordinal[ordinal] for ordinal in ordinals if ordinal in by_ordinal]
+
+    def _match(self, session, age, ordinal):
+        return session.query(AgeMatch.actor_name, AgeMatch.image_path,
+                             AgeMatch.movie_title, AgeMatch.poster_path,
+                             AgeMatch.alias_prob, AgeMatch.alias_ordinal) \
+            .filter(AgeMatch.age == age, AgeMatch.ordinal == ordinal) \
+            .first()
+
+    def pick(self, session, age):
+        '''Return a popularity-weighted random match for age shaped like a GraphQL role, or None.'''
+        count = self._counts.get(age)
+        if not count:
+            return None
+        # walker alias pick: a uniform slot, then keep it or take its alias
+        match = self._match(session, age, random.randrange(count))
+        if match is not None and match.alias_prob is not None and \
+                random.random() >= match.alias_prob:
+            match = self._match(session, age, match.alias_ordinal)
+        if match is None:
+            return None
+        actor_name, image_path, movie_title, poster_path, _, _ = match
+        return {
+            'actor': {'actorName': actor_name, 'imagePath': image_path},
+            'movie': {'movieTitle': movie_title, 'posterPath': poster_path},
+        }
@@ -1,18 +1,65 @@
+import base64
+import binascii
+import random
 import graphene
-from graphene_sqlalchemy import SQLAlchemyObjectType, SQLAlchemyConnectionField
-from models import Actor as ActorModel, Movie as MovieModel, Role as RoleModel
+from graphql import GraphQLError
+from sqlalchemy import func, tuple_
+from graphene_sqlalchemy import SQLAlchemyObjectType
+from graphql_cache import LRUDocumentBackend, PersistedQueries
+from loaders import batched_connection_field_factory, batched_resolver
+from query_cost import CappedConnectionField
+from models import Actor as ActorModel, Movie as MovieModel, Role as RoleModel, \
+    AgeMatch as AgeMatchModel
+
+ROLES_DEFAULT_LIMIT = 100  # roles returned when no limit is given
+ROLES_MAX_LIMIT = 1000  # hard cap on roles returned by one query
+RANDOM_ROLE_MAX_COUNT = 50  # hard cap on roles sampled by one query
+
+# what the home page shows, available to clients as a persisted query
+RANDOM_ROLE_QUERY = '''
+query RandomRole($age: Int!) {
+    randomRole(actorAge: $age) {
+        actor {
+            actorName
+            imagePath
+        }
+        movie {
+            movieTitle
+            posterPath
+        }
+    }
+}
+'''
 
 
 class Actor(SQLAlchemyObjectType):
     class Meta:
         model = ActorModel
         interfaces = (graphene.relay.Node,)
+        connection_field_factory = batched_connection_field_factory
 
 
 class Movie(SQLAlchemyObjectType):
     class Meta:
         model = MovieModel
         interfaces = (graphene.relay.Node,)
+        connection_field_factory = batched_connection_field_factory
+
+
+def encode_role_cursor(role):
+    '''Opaque keyset cursor holding a role's (actor_age, actor_id, movie_id).'''
+    key = f'{role.actor_age}:{role.actor_id}:{role.movie_id}'
+    return base64.urlsafe_b64encode(key.encode('ascii')).decode('ascii')
+
+
+def decode_role_cursor(cursor):
+    '''Turn a cursor back into its (actor_age, actor_id, movie_id) key.'''
+    try:
+        key = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('ascii')
+        actor_age, actor_id, movie_id = (int(part) for part in key.split(':'))
+    except (binascii.Error, UnicodeError, ValueError) as e:
+        raise GraphQLError(f'Invalid cursor: {cursor}') from e
+    return actor_age, actor_id, movie_id
 
 
 class Role(SQLAlchemyObjectType):
@@ -20,32 +67,110 @@ class Role(SQLAlchemyObjectType):
         model = RoleModel
         interfaces = (graphene.relay.Node,)
 
+    cursor = graphene.String(description='Pass as roles(after:) to continue after this role.')
+
+    resolve_actor = batched_resolver('actor')
+    resolve_movie = batched_resolver('movie')
+
+    def resolve_cursor(self, info):
+        if self.actor_age is None:
+            return None
+        return encode_role_cursor(self)
+
+
+class AgeMatch(SQLAlchemyObjectType):
+    class Meta:
+        model = AgeMatchModel
+
 
 class Query(graphene.ObjectType):
     node = graphene.relay.Node.Field()
-    all_actors = SQLAlchemyConnectionField(Actor.connection)
-    all_movies = SQLAlchemyConnectionField(Movie.connection)
-    all_roles = SQLAlchemyConnectionField(Role.connection)
+    all_actors = CappedConnectionField(Actor.connection)
+    all_movies = CappedConnectionField(Movie.connection)
+    all_roles = CappedConnectionField(Role.connection)
 
-    roles = graphene.List(Role, actor_age=graphene.Int())
+    roles = graphene.List(Role, actor_age=graphene.Int(), tolerance=graphene.Int(),
+                          min_age=graphene.Int(), max_age=graphene.Int(),
+                          after=graphene.String(),
+                          limit=graphene.Int(default_value=ROLES_DEFAULT_LIMIT))
+    random_role = graphene.List(Role, actor_age=graphene.Int(required=True),
+                                count=graphene.Int(default_value=1))
+    age_match = graphene.Field(AgeMatch, age=graphene.Int(required=True),
+                               ordinal=graphene.Int(required=True))
+    age_match_count = graphene.Int(age=graphene.Int(required=True))
 
-    def resolve_roles(self, info, actor_age=None):
+    def resolve_roles(self, info, actor_age=None, tolerance=None, min_age=None,
+                      max_age=None, after=None, limit=ROLES_DEFAULT_LIMIT):
+        '''Page through roles in (actor_age, actor_id, movie_id) order by index range scan.'''
         session = info.context['session']  # Get session from context
-        query = Role.get_query(info)
-        # print("Resolving roles with actor_age:", actor_age)
+        if tolerance is not None:
+            if actor_age is None:
+                raise GraphQLError('tolerance needs actorAge')
+            if tolerance < 0:
+                raise GraphQLError('tolerance must not be negative')
+
+        # narrow to one age range; every bound is optional
+        low, high = min_age, max_age
         if actor_age is not None:
-            # print("Query before filter:", query)
-            if hasattr(RoleModel, 'actor_age'):
-                # print("Role model has attribute 'actor_age'")
-                query = query.filter(RoleModel.actor_age == actor_age)
-            else:
-                pass
-                # print("Role model does NOT have attribute 'actor_age'")
-            # print("Query after filter:", query)
+            spread = tolerance or 0
+            low = actor_age - spread if low is None else max(low, actor_age - spread)
+            high = actor_age + spread if high is None else min(high, actor_age + spread)
+
+        query = Role.get_query(info).filter(RoleModel.actor_age.isnot(None))
+        key = decode_role_cursor(after) if after is not None else None
+        if key is not None and (low is None or key[0] >= low):
+            # keyset: seek straight past the cursor's row; the cursor already
+            # implies the lower bound, and sqlite only seeks on one of the two
+            query = query.filter(tuple_(RoleModel.actor_age, RoleModel.actor_id,
+                                        RoleModel.movie_id) > key)
+        elif low is not None:
+            query = query.filter(RoleModel.actor_age >= low)
+        if high is not None:
+            query = query.filter(RoleModel.actor_age <= high)
+
+        limit = max(0, min(limit, ROLES_MAX_LIMIT))
+        return query.with_session(session) \
+            .order_by(RoleModel.actor_age, RoleModel.actor_id, RoleModel.movie_id) \
+            .limit(limit).all()
+
+    def resolve_random_role(self, info, actor_age, count=1):
+        '''Sample roles for an age by their dense age_matches ordinals.'''
+        session = info.context['session']
+        count = max(0, min(count, RANDOM_ROLE_MAX_COUNT))
 
-        roles = query.with_session(session).all()
-        # print(f"Roles found: {roles}")
-        return roles
+        # ordinals run densely from 0, so the largest one is a primary-key seek
+        last = session.query(func.max(AgeMatchModel.ordinal)) \
+            .filter(AgeMatchModel.age == actor_age).scalar()
+        if last is None or not count:
+            return []
+
+        # pick random ordinals, then load just those roles in one query
+        ordinals = random.sample(range(last + 1), min(count, last + 1))
+        rows = session.query(AgeMatchModel.ordinal, RoleModel) \
+            .join(RoleModel, RoleModel.id == AgeMatchModel.role_id) \
+            .filter(AgeMatchModel.age == actor_age, AgeMatchModel.ordinal.in_(ordinals))
+        by_ordinal = dict(rows)
+        return [by_ordinal[ordinal] for ordinal in ordinals if ordinal in by_ordinal]
+
+    def resolve_age_match(self, info, age, ordinal):
+        '''Read one denormalized match by its primary key.'''
+        session = info.context['session']
+        return session.query(AgeMatchModel).get((age, ordinal))
+
+    def resolve_age_match_count(self, info, age):
+        '''Count matches for an age; valid ordinals are 0 to count - 1.'''
+        session = info.context['session']
+        return session.query(AgeMatchModel) \
+            .filter(AgeMatchModel.age == age).count()
 
 
 schema = graphene.Schema(query=Query)
+
+# caps the resolvers above put on limit and count, for the query cost analyzer
+LIST_SIZE_CAPS = {'Query.roles': ROLES_MAX_LIMIT, 'Query.randomRole': RANDOM_ROLE_MAX_COUNT}
+
+# parse and validate each distinct query once per worker
+document_backend = LRUDocumentBackend()
+persisted_queries = PersistedQueries()
+persisted_queries.pin(RANDOM_ROLE_QUERY)
+document_backend.document_from_string(schema, RANDOM_ROLE_QUERY)
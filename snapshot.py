@@ -0,0 +1,52 @@
+'''Serve the SQLite database read-only and follow snapshot swaps by the pipeline.'''
+import logging
+import os
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+
+def sqlite_file(uri):
+    '''Return the file behind a sqlite:/// URI, or None for other databases.'''
+    url = make_url(uri)
+    if url.get_backend_name() != 'sqlite' or url.database in (None, '', ':memory:'):
+        return None
+    return url.database
+
+
+def make_read_only(engine):
+    '''Open every future pooled connection with writes disabled.'''
+    @event.listens_for(engine, 'connect')
+    def set_query_only(dbapi_connection, _record):
+        dbapi_connection.execute('PRAGMA query_only = ON')
+
+    engine.dispose()
+
+
+class SnapshotWatcher:
+    '''Notice when the database file is replaced and reopen the pool on the new one.'''
+
+    def __init__(self, path, engine, on_swap=None):
+        self.path = path
+        self.engine = engine
+        self.on_swap = on_swap
+        self.identity = self._identity()
+
+    def _identity(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    def check(self):
+        '''Reopen pooled connections if a new snapshot has been swapped in.'''
+        identity = self._identity()
+        if identity == self.identity:
+            return False
+        self.identity = identity
+        # idle connections close now; in-flight ones finish on the old file
+        self.engine.dispose()
+        if self.on_swap:
+            self.on_swap()
+        logging.info("Reopened database after snapshot swap: %s", self.path)
+        return True
@@ -0,0 +1,98 @@
+'''Cost estimates must match what the resolvers will actually return.'''
+import os
+import sys
+import time
+
+import pytest
+
+from graphql import parse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+from query_cost import (CONNECTION_MAX_FIRST, QUERY_MAX_COST, CostAnalyzer, CostBudgets,
+                        CostLimitingBackend, QueryCostError)
+from schema import LIST_SIZE_CAPS, ROLES_MAX_LIMIT, schema
+
+
+def cost(query, variables=None):
+    return CostAnalyzer(schema, parse(query), variables, LIST_SIZE_CAPS).analyze()[0]
+
+
+def test_unsupplied_variable_uses_operation_default():
+    query = 'query($n: Int = 1000) { roles(limit: $n) { actor { actorName } } }'
+    # each role costs itself, its actor and the actor's name
+    assert cost(query) == 1000 * 3
+    assert cost(query, {'n': 10}) == 10 * 3
+
+
+def test_connection_variable_default_multiplies_nested_pages():
+    query = '''query($n: Int = 200) {
+        allActors(first: $n) { edges { node { roles(first: $n) { edges { node { id } } } } } }
+    }'''
+    # connection, edges and node at each level, plus id at the bottom
+    inner = CONNECTION_MAX_FIRST * (1 + 1 + 1 + 1)
+    assert cost(query) == CONNECTION_MAX_FIRST * (1 + 1 + 1 + inner)
+    assert cost(query) > QUERY_MAX_COST
+
+
+def test_limit_and_count_are_clamped_like_the_resolvers():
+    assert cost('{ roles(limit: 100000) { id } }') == ROLES_MAX_LIMIT * 2
+    assert cost('{ randomRole(actorAge: 30, count: 100000) { id } }') == \
+        LIST_SIZE_CAPS['Query.randomRole'] * 2
+
+
+def fragment_bomb(levels):
+    '''Each fragment spreads the next one twice, doubling the cost per level.'''
+    fragments = [f'fragment F{level} on Role {{ ...F{level + 1} ...F{level + 1} }}'
+                 for level in range(levels)]
+    fragments.append(f'fragment F{levels} on Role {{ id }}')
+    return '{ roles(limit: 1) { ...F0 } } ' + ' '.join(fragments)
+
+
+def test_fragments_are_costed_once_per_depth():
+    start = time.perf_counter()
+    assert cost(fragment_bomb(40)) == 1 + 2 ** 40
+    assert time.perf_counter() - start < 1
+
+
+def test_walk_stops_at_the_limits():
+    analyzer = CostAnalyzer(schema, parse(fragment_bomb(20)), None, LIST_SIZE_CAPS,
+                            max_cost=QUERY_MAX_COST)
+    with pytest.raises(QueryCostError):
+        analyzer.analyze()
+    deep = '{ allActors { edges { node { roles { edges { node { actor { id } } } } } } } }'
+    analyzer = CostAnalyzer(schema, parse(deep), None, LIST_SIZE_CAPS, max_depth=3)
+    with pytest.raises(QueryCostError):
+        analyzer.analyze()
+
+
+QUERY_WITH_FIRST = 'query($n: Int) { allActors(first: $n) { edges { node { id } } } }'
+
+
+@pytest.mark.parametrize('variables', [{'n': 'ten'}, {'n': [10]}, {'n': True}, [['n', 10]]])
+def test_wrongly_typed_variables_are_costed_as_absent(variables):
+    assert cost(QUERY_WITH_FIRST, variables) == cost(QUERY_WITH_FIRST)
+
+
+def test_numeric_string_variables_are_costed_like_ints():
+    # graphql-core coerces '10' to 10 for an Int, so it must cost the same
+    assert cost(QUERY_WITH_FIRST, {'n': '10'}) == cost(QUERY_WITH_FIRST, {'n': 10})
+
+
+def test_variables_that_are_not_an_object_are_rejected():
+    class Document:  # pylint: disable=too-few-public-methods
+        document_ast = parse(QUERY_WITH_FIRST)
+
+        def execute(self, *args, **kwargs):
+            raise AssertionError('must not execute')
+
+    class Backend:  # pylint: disable=too-few-public-methods
+        def document_from_string(self, schema, document_string):
+            return Document()
+
+    backend = CostLimitingBackend(Backend(), CostBudgets(), lambda: 'client')
+    result = backend.document_from_string(schema, QUERY_WITH_FIRST).execute(
+        variable_values=[['n', 10]])
+    assert result.invalid
+    assert str(result.errors[0]) == 'Variables must be a JSON object'
@@ -0,0 +1,95 @@
+'''Concurrent, rate-limited client for the TMDB API.'''
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from http_cache import CacheMiss
+
+TIMEOUT = 10  # seconds per request
+MAX_RETRIES = 4  # extra attempts after a 429, 5xx or connection error
+BACKOFF_BASE = 0.5  # seconds, doubled after each failed attempt
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class RateLimiter:
+    '''Token bucket shared by every worker thread.'''
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        '''Block until a request may be sent.'''
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class TMDBClient:
+    '''Pooled keep-alive session with shared rate limiting and retries.'''
+
+    def __init__(self, api_key, base_url, requests_per_second, max_workers, cache=None):
+        self.api_key = api_key
+        self.cache = cache
+        self.base_url = base_url
+        self.max_workers = max_workers
+        self.limiter = RateLimiter(requests_per_second)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, path, **params):
+        '''GET a TMDB path and return its JSON, retrying with backoff.'''
+        url = f'{self.base_url}{path}'
+        if self.cache:
+            cached = self.cache.get_json(url, params)
+            if cached is not None:
+                return cached
+            if self.cache.offline:
+                raise CacheMiss(f'{path} is not cached')
+
+        params['api_key'] = self.api_key
+        error = None
+        for attempt in range(MAX_RETRIES + 1):
+            self.limiter.acquire()
+            try:
+                response = self.session.get(url, params=params, timeout=TIMEOUT)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                error = e
+                delay = BACKOFF_BASE * 2 ** attempt
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    response.raise_for_status()
+                    data = response.json()
+                    if self.cache:
+                        self.cache.store_bytes(url, params, response.content)
+                    return data
+                error = requests.exceptions.HTTPError(
+                    f'{response.status_code} for {path}', response=response)
+                # honour TMDB's Retry-After on 429s
+                retry_after = response.headers.get('Retry-After', '')
+                delay = float(retry_after) if retry_after.isdigit() \
+                    else BACKOFF_BASE * 2 ** attempt
+            if attempt < MAX_RETRIES:
+                logging.warning("Retrying %s in %.1fs: %s", path, delay, error)
+                time.sleep(delay)
+        raise error
+
+    def map(self, fn, items):
+        '''Run fn over items on the worker pool, yielding results in order.'''
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            yield from executor.map(fn, items)
@@ -0,0 +1,48 @@
+'''Walker alias tables, so a popularity-weighted pick costs one or two row reads.'''
+from itertools import groupby
+from operator import itemgetter
+
+
+def build_alias(weights):
+    '''Return (prob, alias) lists for weights using Vose's method.
+
+    To pick: take a uniform index i, keep it with probability prob[i],
+    otherwise use alias[i].
+    '''
+    count = len(weights)
+    total = float(sum(weights))
+    prob = [1.0] * count
+    alias = list(range(count))
+    if not count or total <= 0:
+        return prob, alias
+
+    scaled = [weight * count / total for weight in weights]
+    small = [idx for idx, value in enumerate(scaled) if value < 1.0]
+    large = [idx for idx, value in enumerate(scaled) if value >= 1.0]
+    while small and large:
+        less, more = small.pop(), large.pop()
+        prob[less] = scaled[less]
+        alias[less] = more
+        # the large entry gives away what fills the small one's column
+        scaled[more] += scaled[less] - 1.0
+        (small if scaled[more] < 1.0 else large).append(more)
+    # anything left over is 1.0 up to rounding and keeps itself
+    return prob, alias
+
+
+def build_alias_tables(conn):
+    '''Fill alias_prob and alias_ordinal in age_matches, one alias table per age.'''
+    cursor = conn.cursor()
+    rows = cursor.execute(
+        'SELECT age, ordinal, weight FROM age_matches ORDER BY age, ordinal').fetchall()
+    updates = []
+    for age, matches in groupby(rows, key=itemgetter(0)):
+        matches = list(matches)  # ordinals run densely from 0
+        prob, alias = build_alias([weight or 0.0 for _, _, weight in matches])
+        updates.extend((prob[ordinal], alias[ordinal], age, ordinal)
+                       for _, ordinal, _ in matches)
+    with conn:
+        cursor.executemany('''
+        UPDATE age_matches SET alias_prob = ?, alias_ordinal = ?
+        WHERE age = ? AND ordinal = ?''', updates)
+    return len(updates)